@@ -4,18 +4,51 @@
 
 
 import json
+import base64
+import hashlib
+import math
+import sqlite3
+import csv
+import gzip
+import re
+import select
+from collections import namedtuple, OrderedDict
+import atexit
+import queue
+import uuid
+import os
+import cProfile
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
 import dateutil.parser
 import babel
-from flask import Flask, render_template, request, Response, flash, redirect, url_for
+from flask import Flask, render_template, request, Response, flash, redirect, url_for, jsonify, abort, g, has_request_context, session
+from flask.logging import default_handler
+from jinja2.bccache import Bucket, FileSystemBytecodeCache
+from werkzeug.exceptions import TooManyRequests
+from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_moment import Moment
 from flask_sqlalchemy import SQLAlchemy
 import logging
 from logging import Formatter, FileHandler
+from logging.handlers import QueueHandler, QueueListener, WatchedFileHandler
 from flask_wtf import Form
 from forms import *
 from flask_migrate import Migrate
 from sqlalchemy.orm import relationship
-from sqlalchemy import func
+from sqlalchemy import func, and_, or_, exc, text, event, literal, literal_column, tuple_, union_all
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects import postgresql
+try:
+  import numpy as np
+  from scipy import sparse
+except ImportError:
+  np = sparse = None
 
 # ----------------------------------------------------------------------------#
 # App Config.
@@ -24,6 +57,9 @@ from sqlalchemy import func
 app = Flask(__name__)
 moment = Moment(app)
 app.config.from_object('config')
+if app.config['PROXY_FIX_X_FOR']:
+  # request.remote_addr becomes the client address the trusted proxies report
+  app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 
@@ -33,14 +69,22 @@ migrate = Migrate(app, db)
 # Models.
 # ----------------------------------------------------------------------------#
 
+# on Postgres this is a parent table range-partitioned by month of start_time with
+# primary key (id, start_time); see 'Show partitions and archive' below
 ShowDetails = db.Table('showdetails',
   db.Column('id', db.Integer, autoincrement=True, primary_key=True), 
-  db.Column('venue_id', db.Integer, db.ForeignKey('venues.id')), 
-  db.Column('artist_id', db.Integer, db.ForeignKey('artists.id')), 
-  db.Column('start_time', db.String, nullable=False))
+  db.Column('venue_id', db.Integer, db.ForeignKey('venues.id', ondelete='CASCADE')), 
+  db.Column('artist_id', db.Integer, db.ForeignKey('artists.id', ondelete='CASCADE')), 
+  db.Column('start_time', db.DateTime, nullable=False),
+  db.Column('duration', db.Integer, nullable=False, server_default='120'),
+  db.Index('ix_showdetails_venue_id_start_time', 'venue_id', 'start_time'),
+  db.Index('ix_showdetails_artist_id_start_time', 'artist_id', 'start_time'))
  
 class Venue(db.Model):
     __tablename__ = 'venues'
+    # backs the area list and per-area listing on /venues; soft-deleted rows are left out of the index
+    __table_args__ = (db.Index('ix_venues_live_state_city_name', 'state', 'city', 'name',
+                               postgresql_where=text('deleted_at IS NULL'), sqlite_where=text('deleted_at IS NULL')),)
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
@@ -54,6 +98,10 @@ class Venue(db.Model):
     website = db.Column(db.String(120))
     seeking_talent = db.Column(db.String(120))
     seeking_description = db.Column(db.String(120))
+    # bit i set when the venue plays MATCH_GENRES[i]; see 'Matching' below
+    genre_mask = db.Column(db.BigInteger)
+    deleted_at = db.Column(db.DateTime)
+    idempotency_key = db.Column(db.String(64), unique=True)
     artists = db.relationship('Artist', secondary=ShowDetails, backref=db.backref('Venue'))
 
     # TODO: implement any missing fields, as a database migration using Flask-Migrate
@@ -61,6 +109,8 @@ class Venue(db.Model):
 
 class Artist(db.Model):
     __tablename__ = 'artists'
+    __table_args__ = (db.Index('ix_artists_live_name', 'name',
+                               postgresql_where=text('deleted_at IS NULL'), sqlite_where=text('deleted_at IS NULL')),)
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
@@ -73,19 +123,334 @@ class Artist(db.Model):
     website = db.Column(db.String(120))
     seeking_venue = db.Column(db.String(120))
     seeking_description = db.Column(db.String(120))
+    genre_mask = db.Column(db.BigInteger)
+    deleted_at = db.Column(db.DateTime)
+    idempotency_key = db.Column(db.String(64), unique=True)
     venues = db.relationship('Venue', secondary=ShowDetails, backref=db.backref('Artist'))
 
     # TODO: implement any missing fields, as a database migration using Flask-Migrate
 
+# upper-cased first character of an artist's name. /artists buckets the directory on
+# it, with anything outside A-Z under '#', and pages through a bucket by (name, id).
+# Literal arguments keep the SQL identical to the indexed expression.
+artist_initial = func.upper(func.substr(Artist.name, literal_column('1'), literal_column('1')))
+db.Index('ix_artists_live_initial_name', artist_initial, Artist.name, Artist.id,
+         postgresql_where=Artist.deleted_at.is_(None), sqlite_where=Artist.deleted_at.is_(None))
+
+# rolling popularity: shows_<n>d counts the shows starting within n days of
+# popularity_state.as_of. Show writes adjust them in the same transaction and a
+# periodic job slides as_of forward; see 'Popularity rankings' below.
+VenuePopularity = db.Table('venue_popularity',
+  db.Column('venue_id', db.Integer, db.ForeignKey('venues.id', ondelete='CASCADE'), primary_key=True),
+  db.Column('shows_7d', db.Integer, nullable=False, server_default='0'),
+  db.Column('shows_30d', db.Integer, nullable=False, server_default='0'),
+  db.Column('shows_90d', db.Integer, nullable=False, server_default='0'),
+  db.Index('ix_venue_popularity_shows_7d', 'shows_7d', 'venue_id'),
+  db.Index('ix_venue_popularity_shows_30d', 'shows_30d', 'venue_id'),
+  db.Index('ix_venue_popularity_shows_90d', 'shows_90d', 'venue_id'))
+
+ArtistPopularity = db.Table('artist_popularity',
+  db.Column('artist_id', db.Integer, db.ForeignKey('artists.id', ondelete='CASCADE'), primary_key=True),
+  db.Column('shows_7d', db.Integer, nullable=False, server_default='0'),
+  db.Column('shows_30d', db.Integer, nullable=False, server_default='0'),
+  db.Column('shows_90d', db.Integer, nullable=False, server_default='0'),
+  db.Index('ix_artist_popularity_shows_7d', 'shows_7d', 'artist_id'),
+  db.Index('ix_artist_popularity_shows_30d', 'shows_30d', 'artist_id'),
+  db.Index('ix_artist_popularity_shows_90d', 'shows_90d', 'artist_id'))
+
+PopularityState = db.Table('popularity_state',
+  db.Column('id', db.Integer, primary_key=True),
+  db.Column('as_of', db.DateTime, nullable=False))
+
+# top SIMILAR_ARTISTS_K "fans also like" artists per artist, best first; written by
+# `flask build-similar-artists`, read by show_artist with one primary key range scan
+SimilarArtists = db.Table('similar_artists',
+  db.Column('artist_id', db.Integer, db.ForeignKey('artists.id', ondelete='CASCADE'), primary_key=True),
+  db.Column('rank', db.Integer, primary_key=True, autoincrement=False),
+  db.Column('similar_id', db.Integer, db.ForeignKey('artists.id', ondelete='CASCADE'), nullable=False),
+  db.Column('score', db.Float, nullable=False))
+
+# seeking venues and artists are matched on shared genres and city/state through
+# these partial indexes; only rows that are live and seeking are indexed
+db.Index('ix_venues_seeking_state_city', Venue.state, Venue.city,
+         postgresql_where=and_(Venue.seeking_talent == 'True', Venue.deleted_at.is_(None)),
+         sqlite_where=and_(Venue.seeking_talent == 'True', Venue.deleted_at.is_(None)))
+db.Index('ix_artists_seeking_state_city', Artist.state, Artist.city,
+         postgresql_where=and_(Artist.seeking_venue == 'True', Artist.deleted_at.is_(None)),
+         sqlite_where=and_(Artist.seeking_venue == 'True', Artist.deleted_at.is_(None)))
+
+# each seeking venue's (artist's) best MATCHES_PER_ENTITY seeking artists (venues),
+# kept exact by update_matches() on every venue and artist write
+VenueMatches = db.Table('venue_matches',
+  db.Column('venue_id', db.Integer, db.ForeignKey('venues.id', ondelete='CASCADE'), primary_key=True),
+  db.Column('artist_id', db.Integer, db.ForeignKey('artists.id', ondelete='CASCADE'), primary_key=True),
+  db.Column('score', db.Float, nullable=False),
+  db.Index('ix_venue_matches_venue_id_score', 'venue_id', 'score'),
+  db.Index('ix_venue_matches_artist_id', 'artist_id'))
+
+ArtistMatches = db.Table('artist_matches',
+  db.Column('artist_id', db.Integer, db.ForeignKey('artists.id', ondelete='CASCADE'), primary_key=True),
+  db.Column('venue_id', db.Integer, db.ForeignKey('venues.id', ondelete='CASCADE'), primary_key=True),
+  db.Column('score', db.Float, nullable=False),
+  db.Index('ix_artist_matches_artist_id_score', 'artist_id', 'score'),
+  db.Index('ix_artist_matches_venue_id', 'venue_id'))
+
 # TODO Implement Show and Artist models, and complete all model relationships and properties, as a database migration.
 
+# ----------------------------------------------------------------------------#
+# Entity cache.
+# ----------------------------------------------------------------------------#
+
+
+class EntityCache(object):
+  # bounded LRU of id -> (id, name, image_link) for a model, filled in bulk. Writers
+  # call broadcast_invalidation() so every worker process evicts its copy.
+  def __init__(self, model, maxsize):
+    self.model = model
+    self.maxsize = maxsize
+    self.entries = OrderedDict()
+    self.generation = 0
+    self.lock = threading.Lock()
+
+  def get_many(self, ids):
+    # summaries for every live id; soft-deleted or unknown ids are left out
+    start_invalidation_listener()
+    found = {}
+    missing = []
+    with self.lock:
+      generation = self.generation
+      for entity_id in set(ids):
+        if entity_id in self.entries:
+          self.entries.move_to_end(entity_id)
+          found[entity_id] = self.entries[entity_id]
+        else:
+          missing.append(entity_id)
+    if missing:
+      rows = db.session.query(self.model.id, self.model.name, self.model.image_link).filter(
+        self.model.id.in_(missing), self.model.deleted_at.is_(None)).all()
+      with self.lock:
+        # skip caching if an invalidation arrived while the rows were being read
+        for row in rows:
+          found[row.id] = row
+          if self.generation == generation:
+            self.entries[row.id] = row
+        while len(self.entries) > self.maxsize:
+          self.entries.popitem(last=False)
+    return found
+
+  def evict(self, entity_id):
+    with self.lock:
+      self.generation += 1
+      self.entries.pop(entity_id, None)
+
+  def clear(self):
+    with self.lock:
+      self.generation += 1
+      self.entries.clear()
+
+
+class CalendarCache(object):
+  # bounded LRU of id -> rendered .ics feed for one kind of entity. An entry stays
+  # until apply_invalidation() reports a change to that venue's or artist's shows.
+  def __init__(self, maxsize):
+    self.maxsize = maxsize
+    self.entries = OrderedDict()
+    self.generation = 0
+    self.lock = threading.Lock()
+
+  def get(self, entity_id):
+    # returns (entry or None, generation to hand back to put())
+    start_invalidation_listener()
+    with self.lock:
+      entry = self.entries.get(entity_id)
+      if entry is not None:
+        self.entries.move_to_end(entity_id)
+      return entry, self.generation
+
+  def put(self, entity_id, entry, generation):
+    with self.lock:
+      # an invalidation that arrived while the feed was built wins
+      if self.generation == generation:
+        self.entries[entity_id] = entry
+        while len(self.entries) > self.maxsize:
+          self.entries.popitem(last=False)
+
+  def evict(self, entity_id):
+    with self.lock:
+      self.generation += 1
+      self.entries.pop(entity_id, None)
+
+  def clear(self):
+    with self.lock:
+      self.generation += 1
+      self.entries.clear()
+
+
+class AggregateCache(object):
+  # one small aggregate shared by every request in this worker, rebuilt after ttl
+  # seconds or sooner when apply_invalidation() clears it
+  def __init__(self, ttl):
+    self.ttl = ttl
+    self.value = None
+    self.built = 0
+    self.generation = 0
+    self.lock = threading.Lock()
+
+  def get(self, build):
+    start_invalidation_listener()
+    with self.lock:
+      if self.value is not None and time.time() - self.built < self.ttl:
+        return self.value
+      generation = self.generation
+    value = build()
+    with self.lock:
+      if self.generation == generation:
+        self.value, self.built = value, time.time()
+    return value
+
+  def clear(self):
+    with self.lock:
+      self.generation += 1
+      self.value = None
+
+
+venue_cache = EntityCache(Venue, app.config['ENTITY_CACHE_SIZE'])
+artist_cache = EntityCache(Artist, app.config['ENTITY_CACHE_SIZE'])
+entity_caches = {'venue': venue_cache, 'artist': artist_cache}
+calendar_caches = {'venue': CalendarCache(app.config['CALENDAR_CACHE_SIZE']),
+                   'artist': CalendarCache(app.config['CALENDAR_CACHE_SIZE'])}
+artist_letter_cache = AggregateCache(app.config['ARTIST_LETTER_COUNTS_TTL'])
+invalidation_lock = threading.Lock()
+invalidation_thread = None
+
+
+def apply_invalidation(message):
+  kind, _, entity_id = message.partition(':')
+  if kind.endswith('_calendar') and kind[:-len('_calendar')] in calendar_caches and entity_id.isdigit():
+    calendar_caches[kind[:-len('_calendar')]].evict(int(entity_id))
+  elif kind in entity_caches and entity_id.isdigit():
+    entity_caches[kind].evict(int(entity_id))
+    calendar_caches[kind].evict(int(entity_id))
+    if kind == 'artist':
+      artist_letter_cache.clear()
+
+
+def clear_caches():
+  for cache in list(entity_caches.values()) + list(calendar_caches.values()) + [artist_letter_cache]:
+    cache.clear()
+
+
+def broadcast_invalidation(kind, *entity_ids):
+  # called after a committed edit, delete or show listing. Postgres carries the
+  # messages to every worker with NOTIFY; elsewhere they are appended to the
+  # ENTITY_CACHE_CHANNEL file, which is started afresh once it grows past
+  # ENTITY_CACHE_CHANNEL_MAX_BYTES.
+  messages = ['%s:%s' % (kind, entity_id) for entity_id in entity_ids]
+  for message in messages:
+    apply_invalidation(message)
+  if db.engine.dialect.name == 'postgresql':
+    db.session.execute(text('SELECT pg_notify(:channel, message) FROM unnest(CAST(:messages AS text[])) AS message'),
+                       {'channel': 'fyyur_entity_cache', 'messages': messages})
+    db.session.commit()
+  else:
+    path = app.config['ENTITY_CACHE_CHANNEL']
+    with open(path, 'a') as channel:
+      channel.write(''.join(message + '\n' for message in messages))
+      size = channel.tell()
+    if size > app.config['ENTITY_CACHE_CHANNEL_MAX_BYTES']:
+      # a new file (new inode) replaces the old one; each listener notices the
+      # switch and clears its caches once, so nothing published before is missed
+      fresh = '%s.%d' % (path, os.getpid())
+      open(fresh, 'w').close()
+      os.replace(fresh, path)
+
+
+def broadcast_counterpart_invalidation(kind, *entity_ids):
+  # a calendar feed embeds the names of the other side of each upcoming show, so
+  # editing or deleting a venue also stales the feeds of the artists playing
+  # there (and vice versa). Only those feeds are evicted, not the entity caches.
+  if kind == 'venue':
+    other, column, other_column = 'artist', ShowDetails.c.venue_id, ShowDetails.c.artist_id
+  else:
+    other, column, other_column = 'venue', ShowDetails.c.artist_id, ShowDetails.c.venue_id
+  rows = db.session.query(other_column).filter(
+    column.in_([int(entity_id) for entity_id in entity_ids]),
+    ShowDetails.c.start_time >= datetime.now()
+  ).distinct().all()
+  if rows:
+    broadcast_invalidation(other + '_calendar', *(row[0] for row in rows))
+
+
+def listen_postgres():
+  connection = db.engine.raw_connection()
+  # an autocommit connection with LISTEN registered must never serve a request, so
+  # it leaves the pool now and close() really closes it
+  connection.detach()
+  try:
+    dbapi_connection = connection.connection
+    dbapi_connection.autocommit = True
+    dbapi_connection.cursor().execute('LISTEN fyyur_entity_cache')
+    # anything published while we were not listening is unknown, so start clean
+    clear_caches()
+    while True:
+      if select.select([dbapi_connection], [], [], 60) == ([], [], []):
+        continue
+      dbapi_connection.poll()
+      while dbapi_connection.notifies:
+        apply_invalidation(dbapi_connection.notifies.pop(0).payload)
+  finally:
+    connection.close()
+
+
+def listen_file():
+  path = app.config['ENTITY_CACHE_CHANNEL']
+  stat = os.stat(path) if os.path.exists(path) else None
+  inode, offset = (stat.st_ino, stat.st_size) if stat else (None, 0)
+  while True:
+    time.sleep(app.config['ENTITY_CACHE_POLL_INTERVAL'])
+    if not os.path.exists(path):
+      continue
+    stat = os.stat(path)
+    if stat.st_ino != inode or stat.st_size < offset:
+      # the channel file was truncated or replaced
+      inode, offset = stat.st_ino, 0
+      clear_caches()
+    with open(path) as channel:
+      channel.seek(offset)
+      for line in channel:
+        if not line.endswith('\n'):
+          break
+        offset += len(line)
+        apply_invalidation(line.strip())
+
+
+def invalidation_listener():
+  while True:
+    try:
+      with app.app_context():
+        if db.engine.dialect.name == 'postgresql':
+          listen_postgres()
+        else:
+          listen_file()
+    except Exception:
+      app.logger.exception('entity cache invalidation listener failed')
+      time.sleep(app.config['ENTITY_CACHE_POLL_INTERVAL'])
+
+
+def start_invalidation_listener():
+  global invalidation_thread
+  with invalidation_lock:
+    if invalidation_thread is None:
+      invalidation_thread = threading.Thread(target=invalidation_listener, name='entity-cache', daemon=True)
+      invalidation_thread.start()
+
 # ----------------------------------------------------------------------------#
 # Filters.
 # ----------------------------------------------------------------------------#
 
 
 def format_datetime(value, format='medium'):
-  date = dateutil.parser.parse(value)
+  date = value if isinstance(value, datetime) else dateutil.parser.parse(value)
   if format == 'full':
     format = "EEEE MMMM, d, y 'at' h:mma"
   elif format == 'medium':
@@ -95,14 +460,379 @@ def format_datetime(value, format='medium'):
 
 app.jinja_env.filters['datetime'] = format_datetime
 
+# ----------------------------------------------------------------------------#
+# Template bytecode cache.
+# ----------------------------------------------------------------------------#
+
+
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+  # compiled templates in TEMPLATE_CACHE_DIR, keyed by a hash of each template's
+  # name and source: a deploy only recompiles what changed, and a fresh worker
+  # loads bytecode instead of parsing. Hits, misses and compile time go to /metrics.
+  def __init__(self, directory):
+    super().__init__(directory, '%s.jinja')
+    self.hits = 0
+    self.misses = 0
+    self.compile_seconds = 0.0
+    self.lock = threading.Lock()
+
+  def get_bucket(self, environment, name, filename, source):
+    # the name is part of the key because autoescaping is chosen by file extension
+    key = hashlib.sha1(((name or '') + '\0' + source).encode('utf-8')).hexdigest()
+    bucket = Bucket(environment, key, key)
+    self.load_bytecode(bucket)
+    with self.lock:
+      if bucket.code is None:
+        self.misses += 1
+        # Jinja compiles between get_bucket() and set_bucket()
+        bucket.compile_started = time.perf_counter()
+      else:
+        self.hits += 1
+    return bucket
+
+  def set_bucket(self, bucket):
+    started = getattr(bucket, 'compile_started', None)
+    if started is not None:
+      with self.lock:
+        self.compile_seconds += time.perf_counter() - started
+    super().set_bucket(bucket)
+
+  def dump_bytecode(self, bucket):
+    # write then rename, so another worker never loads a half-written file
+    os.makedirs(self.directory, exist_ok=True)
+    path = os.path.join(self.directory, self.pattern % bucket.key)
+    partial = '%s.%d.tmp' % (path, os.getpid())
+    with open(partial, 'wb') as f:
+      bucket.write_bytecode(f)
+    os.replace(partial, path)
+
+
+template_bytecode_cache = TemplateBytecodeCache(app.config['TEMPLATE_CACHE_DIR'])
+app.jinja_env.bytecode_cache = template_bytecode_cache
+
+
+@app.cli.command('precompile-templates')
+def precompile_templates_command():
+  # flask precompile-templates: run on each host before the workers start; the
+  # Procfile does it on every dyno, since a cache built elsewhere never reaches it
+  for name in app.jinja_env.list_templates(extensions=['html']):
+    app.jinja_env.get_template(name)
+  print('Compiled %d templates in %.3fs (%d already cached)' % (
+    template_bytecode_cache.misses, template_bytecode_cache.compile_seconds, template_bytecode_cache.hits))
+
+# ----------------------------------------------------------------------------#
+# Query budgets.
+# ----------------------------------------------------------------------------#
+
+
+class QueryBudgetExceeded(Exception):
+  pass
+
+
+def query_budget(limit):
+  # declares the most SQL statements a single request to the view may issue
+  def decorator(view):
+    view.query_budget = limit
+    return view
+  return decorator
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def record_statement(conn, cursor, statement, parameters, context, executemany):
+  if has_request_context():
+    g.setdefault('sql_statements', []).append(statement)
+
+
+@app.after_request
+def enforce_query_budget(response):
+  # debug and test runs fail loudly on an N+1 regression; production logs a sampled warning
+  limit = getattr(app.view_functions.get(request.endpoint), 'query_budget', None)
+  statements = g.get('sql_statements', [])
+  if limit is None or len(statements) <= limit:
+    return response
+  message = '%s issued %d SQL statements (budget %d):\n%s' % (
+    request.endpoint, len(statements), limit, '\n'.join(statements))
+  if app.debug or app.testing or app.config['QUERY_BUDGET_STRICT']:
+    raise QueryBudgetExceeded(message)
+  if random.random() < app.config['QUERY_BUDGET_SAMPLE_RATE']:
+    app.logger.warning(message)
+  return response
+
+# ----------------------------------------------------------------------------#
+# Slow query log.
+# ----------------------------------------------------------------------------#
+
+slow_query_logger = logging.getLogger('fyyur.slowquery')
+slow_query_logger.propagate = False
+slow_query_logger.setLevel(logging.INFO)
+slow_query_handler = FileHandler(app.config['SLOW_QUERY_LOG'], delay=True)
+slow_query_handler.setFormatter(Formatter('%(message)s'))
+slow_query_logger.addHandler(slow_query_handler)
+
+# plans are captured off the request thread, one at a time
+explain_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='explain')
+slow_query_last_logged = {}
+slow_query_lock = threading.Lock()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+  conn.info.setdefault('query_start_time', []).append(time.time())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def log_slow_query(conn, cursor, statement, parameters, context, executemany):
+  elapsed = time.time() - conn.info['query_start_time'].pop()
+  if elapsed < app.config['SLOW_QUERY_THRESHOLD']:
+    return
+  # identical statements are logged at most once per SLOW_QUERY_RATE_LIMIT seconds
+  now = time.time()
+  with slow_query_lock:
+    if now - slow_query_last_logged.get(statement, 0) < app.config['SLOW_QUERY_RATE_LIMIT']:
+      return
+    if len(slow_query_last_logged) > 1000:
+      slow_query_last_logged.clear()
+    slow_query_last_logged[statement] = now
+  record = {
+    'time': datetime.now().isoformat(),
+    'duration_ms': round(elapsed * 1000, 3),
+    'endpoint': request.endpoint if has_request_context() else None,
+    'statement': statement,
+    'parameters': parameters
+  }
+  explain_executor.submit(explain_slow_query, conn.engine, record)
+
+
+def explain_slow_query(engine, record):
+  # runs on a separate DBAPI connection inside a transaction that is always rolled
+  # back, so EXPLAIN ANALYZE of a write leaves no trace
+  statement = record['statement']
+  if engine.dialect.name == 'postgresql':
+    analyze = statement.lstrip().upper().startswith(('SELECT', 'WITH'))
+    prefix = 'EXPLAIN (ANALYZE, BUFFERS) ' if analyze else 'EXPLAIN '
+  elif engine.dialect.name == 'sqlite':
+    prefix = 'EXPLAIN QUERY PLAN '
+  else:
+    prefix = None
+  if prefix:
+    connection = engine.raw_connection()
+    try:
+      cursor = connection.cursor()
+      cursor.execute(prefix + statement, record['parameters'])
+      record['plan'] = [' '.join(str(column) for column in row) for row in cursor.fetchall()]
+    except Exception as error:
+      record['plan_error'] = str(error)
+    finally:
+      connection.rollback()
+      connection.close()
+  slow_query_logger.info(json.dumps(record, default=str))
+
+# ----------------------------------------------------------------------------#
+# Local store.
+# ----------------------------------------------------------------------------#
+
+# per-thread connections to the LOCAL_STORE SQLite file, which every worker process
+# on this host opens; its write lock serialises updates across the whole pool
+local_store_state = threading.local()
+
+
+def local_store():
+  connection = getattr(local_store_state, 'connection', None)
+  if connection is None or local_store_state.pid != os.getpid():
+    connection = sqlite3.connect(app.config['LOCAL_STORE'], timeout=1, isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('CREATE TABLE IF NOT EXISTS rate_limit_buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+    connection.execute('CREATE TABLE IF NOT EXISTS rate_limit_counters ('
+                       'endpoint TEXT PRIMARY KEY, allowed INTEGER NOT NULL DEFAULT 0, rejected INTEGER NOT NULL DEFAULT 0)')
+    connection.execute('CREATE TABLE IF NOT EXISTS flight_locks (key TEXT PRIMARY KEY, owner TEXT, started REAL, '
+                       'finished REAL, waiters INTEGER NOT NULL DEFAULT 0, mimetype TEXT, body BLOB)')
+    local_store_state.connection = connection
+    local_store_state.pid = os.getpid()
+  return connection
+
+# ----------------------------------------------------------------------------#
+# Request profiling.
+# ----------------------------------------------------------------------------#
+
+
+@app.before_request
+def start_profiler():
+  # profile this request when it carries the admin PROFILE_TOKEN (X-Profile header or
+  # ?profile= flag), or when it is picked by PROFILE_SAMPLE_RATE
+  token = app.config['PROFILE_TOKEN']
+  requested = token and token in (request.headers.get('X-Profile'), request.args.get('profile'))
+  if requested or random.random() < app.config['PROFILE_SAMPLE_RATE']:
+    g.profiler = cProfile.Profile()
+    g.profiler.enable()
+
+
+@app.teardown_request
+def save_profile(error=None):
+  # cProfile output (.prof) opens in pstats, snakeviz or flameprof; only the
+  # newest PROFILE_KEEP files are kept
+  profiler = g.pop('profiler', None)
+  if profiler is None:
+    return
+  profiler.disable()
+  directory = app.config['PROFILE_DIR']
+  os.makedirs(directory, exist_ok=True)
+  filename = '%s-%s-%dsql.prof' % (
+    datetime.now().strftime('%Y%m%d%H%M%S%f'), request.endpoint, len(g.get('sql_statements', [])))
+  profiler.dump_stats(os.path.join(directory, filename))
+  profiles = sorted(name for name in os.listdir(directory) if name.endswith('.prof'))
+  for name in profiles[:-app.config['PROFILE_KEEP']]:
+    os.remove(os.path.join(directory, name))
+
+# ----------------------------------------------------------------------------#
+# Request coalescing.
+# ----------------------------------------------------------------------------#
+
+class Flight(object):
+  # one in-progress computation of a page; duplicates wait on done
+  def __init__(self):
+    self.done = threading.Event()
+    self.mimetype = None
+    self.body = None
+
+
+flights = {}
+flights_lock = threading.Lock()
+
+
+def claim_flight(key):
+  # returns (token, True) when this worker should compute the page, or the token
+  # of the worker already computing it and False. The leader only writes a small
+  # lock row; a waiter from another worker registers itself on that row.
+  connection = local_store()
+  now = time.time()
+  connection.execute('BEGIN IMMEDIATE')
+  try:
+    row = connection.execute('SELECT owner, started, finished FROM flight_locks WHERE key = ?', (key,)).fetchone()
+    # a leader that has been running longer than SINGLE_FLIGHT_TIMEOUT is presumed dead
+    if row is not None and row[2] is None and row[1] > now - app.config['SINGLE_FLIGHT_TIMEOUT']:
+      connection.execute('UPDATE flight_locks SET waiters = waiters + 1 WHERE key = ?', (key,))
+      connection.execute('COMMIT')
+      return row[0], False
+    token = uuid.uuid4().hex
+    connection.execute('INSERT OR REPLACE INTO flight_locks (key, owner, started) VALUES (?, ?, ?)', (key, token, now))
+    if random.random() < 0.01:
+      connection.execute('DELETE FROM flight_locks WHERE finished < ?', (now - app.config['SINGLE_FLIGHT_TIMEOUT'],))
+    connection.execute('COMMIT')
+    return token, True
+  except BaseException:
+    connection.execute('ROLLBACK')
+    raise
+
+
+def finish_flight(key, token, mimetype, body):
+  # the page is copied into the store only when another worker is waiting for it;
+  # a body of None tells those waiters to compute the page themselves
+  local_store().execute('UPDATE flight_locks SET finished = ?, mimetype = ?, '
+                        'body = CASE WHEN waiters > 0 THEN ? END WHERE key = ? AND owner = ?',
+                        (time.time(), mimetype, body, key, token))
+
+
+def wait_for_flight(key, token):
+  # polls for the result of another worker's flight; None if it failed or timed out
+  deadline = time.time() + app.config['SINGLE_FLIGHT_TIMEOUT']
+  while time.time() < deadline:
+    time.sleep(app.config['SINGLE_FLIGHT_POLL_INTERVAL'])
+    row = local_store().execute('SELECT owner, finished, mimetype, body FROM flight_locks WHERE key = ?', (key,)).fetchone()
+    if row is None or row[0] != token:
+      return None
+    if row[1] is not None:
+      return (row[2], row[3]) if row[3] is not None else None
+  return None
+
+
+def single_flight(view):
+  # concurrent GETs of the same page and arguments are computed once: the first
+  # request leads and the duplicates, in this worker or (through LOCAL_STORE) in
+  # any other, share its response. Waiters compute the page themselves when the
+  # leader fails or takes longer than SINGLE_FLIGHT_TIMEOUT.
+  @functools.wraps(view)
+  def wrapper(*args, **kwargs):
+    # pending flash messages render into the page, so those requests go alone
+    if request.method != 'GET' or '_flashes' in session:
+      return view(*args, **kwargs)
+    key = request.path + '?' + urlencode(sorted(request.args.items(multi=True)))
+    with flights_lock:
+      flight = flights.get(key)
+      leader = flight is None
+      if leader:
+        flight = flights[key] = Flight()
+    if not leader:
+      if flight.done.wait(app.config['SINGLE_FLIGHT_TIMEOUT']) and flight.body is not None:
+        return Response(flight.body, mimetype=flight.mimetype)
+      return view(*args, **kwargs)
+
+    try:
+      try:
+        token, claimed = claim_flight(key)
+      except sqlite3.Error:
+        app.logger.exception('single flight store unavailable; computing %s alone', key)
+        token, claimed = None, True
+      if not claimed:
+        shared = wait_for_flight(key, token)
+        if shared is not None:
+          flight.mimetype, flight.body = shared
+          return Response(flight.body, mimetype=flight.mimetype)
+        token = None
+      response = app.make_response(view(*args, **kwargs))
+      if response.status_code == 200 and not response.direct_passthrough:
+        flight.mimetype, flight.body = response.mimetype, response.get_data()
+      return response
+    finally:
+      if token is not None:
+        try:
+          finish_flight(key, token, flight.mimetype, flight.body)
+        except sqlite3.Error:
+          app.logger.exception('could not publish %s to other workers', key)
+      with flights_lock:
+        flights.pop(key, None)
+      flight.done.set()
+
+  return wrapper
+
 # ----------------------------------------------------------------------------#
 # Controllers.
 # ----------------------------------------------------------------------------#
 
 
+def insert_returning_id(model, values):
+  # creates a row in one round trip: INSERT ... ON CONFLICT (idempotency_key) DO UPDATE
+  # ... RETURNING id. A double-submitted form carries the same key and gets back the
+  # id of the row the first submission created instead of a duplicate.
+  table = model.__table__
+  values = dict(values, idempotency_key=values.get('idempotency_key') or uuid.uuid4().hex)
+  if db.engine.dialect.name == 'postgresql':
+    statement = postgresql.insert(table).values(**values)
+    statement = statement.on_conflict_do_update(
+      index_elements=[table.c.idempotency_key],
+      set_={'idempotency_key': statement.excluded.idempotency_key}
+    ).returning(table.c.id)
+    return db.session.execute(statement).scalar()
+  existing = db.session.query(table.c.id).filter(table.c.idempotency_key == values['idempotency_key']).scalar()
+  if existing is not None:
+    return existing
+  return db.session.execute(table.insert().values(**values)).inserted_primary_key[0]
+
+
+def update_returning_id(model, row_id, values):
+  # UPDATE ... RETURNING id; None when the row does not exist or was deleted
+  table = model.__table__
+  statement = table.update().where(table.c.id == row_id).where(table.c.deleted_at.is_(None)).values(**values)
+  if db.engine.dialect.name == 'postgresql':
+    return db.session.execute(statement.returning(table.c.id)).scalar()
+  return row_id if db.session.execute(statement).rowcount else None
+
+
 @app.route('/')
+@query_budget(0)
 def index():
-  return render_template('pages/home.html')
+  # served from the in-memory snapshot; the request never touches the database
+  wake_home_feed(rebuild=False)
+  return render_template('pages/home.html', feed=home_feed)
 
 
 # ----------------------------------------------------------------------------#
@@ -110,50 +840,135 @@ def index():
 # ----------------------------------------------------------------------------#
 
 
+def upcoming_show_counts(column, ids):
+  # one grouped query for the number of upcoming shows per venue/artist id
+  if not ids:
+    return {}
+  rows = db.session.query(column, func.count()).filter(
+    column.in_(ids),
+    ShowDetails.c.start_time > datetime.now()
+  ).group_by(column).all()
+  return dict(rows)
+
+
+def search_page(model, column, searchterm, page):
+  # one page of live rows whose name contains searchterm. The total comes from a
+  # window count over the same scan and the upcoming-show counts for the page
+  # from one grouped query, so a search costs two statements however broad it is.
+  per_page = app.config['SEARCH_PAGE_SIZE']
+  total = func.count().over().label('total')
+  matches = db.session.query(model.id, model.name, total).filter(
+    model.deleted_at.is_(None),
+    model.name.ilike('%' + searchterm + '%')
+  )
+  searchresults = matches.order_by(model.name, model.id).limit(per_page).offset((page - 1) * per_page).all()
+  showcounts = upcoming_show_counts(column, [searchresult.id for searchresult in searchresults])
+  if searchresults:
+    count = searchresults[0].total
+  elif page > 1:
+    # a page past the last result has no rows to carry the window total
+    count = matches.with_entities(func.count(model.id)).scalar()
+  else:
+    count = 0
+  return {
+    "count": count,
+    "page": page,
+    "has_more": page * per_page < count,
+    "data": [{
+      "id": searchresult.id,
+      "name": searchresult.name,
+      "num_upcoming_shows": showcounts.get(searchresult.id, 0)
+    } for searchresult in searchresults]
+  }
+
+
 @app.route('/venues')
+@query_budget(3)
+@single_flight
 def venues():
-  # TODO: replace with real venues data.
-  #       num_shows should be aggregated based on number of upcoming shows per venue.
-  citydata = db.session.query(Venue.city).distinct().order_by(Venue.state)
+  # optional ?state=&city= filters; ?after= / ?before= are keyset cursors on (state, city)
+  # over the areas, and ?page= pages through the venues of every listed area.
+  # ?sort=popular&window=7|30|90 lists the venues with the most shows coming up instead.
+  state = request.args.get('state', '').strip()
+  city = request.args.get('city', '').strip()
+  page = max(request.args.get('page', 1, type=int), 1)
+  per_area = app.config['VENUES_PER_AREA']
+  offset = (page - 1) * per_area
+
+  if request.args.get('sort') == 'popular':
+    days = popularity_window()
+    per_page = app.config['SEARCH_PAGE_SIZE']
+    ranked = popular('venue', days, per_page + 1, (page - 1) * per_page)
+    return render_template('pages/venues.html', popular=ranked[:per_page], has_more=len(ranked) > per_page,
+                           windows=POPULARITY_WINDOWS, window=days, state=state, city=city, page=page)
+
+  filters = [Venue.deleted_at.is_(None)]
+  if state:
+    filters.append(Venue.state == state)
+  if city:
+    filters.append(Venue.city == city)
+
+  # one page of distinct (state, city) pairs, read straight off ix_venues_live_state_city_name
+  per_page = app.config['AREAS_PER_PAGE']
+  after = decode_cursor(request.args.get('after'))
+  before = decode_cursor(request.args.get('before'))
+  areas = db.session.query(Venue.state, Venue.city).filter(*filters).distinct()
+  if before is not None:
+    areadata = areas.filter(tuple_(Venue.state, Venue.city) < before).order_by(
+      Venue.state.desc(), Venue.city.desc()).limit(per_page + 1).all()
+    has_previous, has_next = len(areadata) > per_page, True
+    areadata = areadata[:per_page][::-1]
+  else:
+    if after is not None:
+      areas = areas.filter(tuple_(Venue.state, Venue.city) > after)
+    areadata = areas.order_by(Venue.state, Venue.city).limit(per_page + 1).all()
+    has_previous, has_next = after is not None, len(areadata) > per_page
+    areadata = areadata[:per_page]
+  if not areadata:
+    return render_template('pages/venues.html', areas=[], state=state, city=city, page=page)
+
+  # one windowed query returns the requested page of venues for the listed areas at once
+  filters.append(tuple_(Venue.state, Venue.city).in_([(area.state, area.city) for area in areadata]))
+  rownum = func.row_number().over(partition_by=(Venue.state, Venue.city), order_by=(Venue.name, Venue.id)).label('rownum')
+  ranked = db.session.query(Venue.id, Venue.name, Venue.state, Venue.city, rownum).filter(*filters).subquery()
+  venuedata = db.session.query(ranked).filter(
+    ranked.c.rownum > offset,
+    ranked.c.rownum <= offset + per_area + 1
+  ).order_by(ranked.c.state, ranked.c.city, ranked.c.rownum).all()
+
+  byarea = {}
+  for venue in venuedata:
+    byarea.setdefault((venue.state, venue.city), []).append(venue)
+  showcounts = upcoming_show_counts(ShowDetails.c.venue_id, [venue.id for venue in venuedata])
+
   data = [{
-    'city': city.city,
-    'state': db.session.query(Venue.state).filter_by(city=city).first(),  # make changes here
+    'city': area.city,
+    'state': area.state,
+    'has_more': len(byarea.get((area.state, area.city), [])) > per_area,
     'venues': [{
       'id': venue.id,
       'name': venue.name,
-      'num_upcoming_shows': (db.session.execute(ShowDetails.select().where(ShowDetails.c.venue_id==venue.id).where(ShowDetails.c.start_time > str(datetime.now())))).rowcount
-      } for venue in db.session.query(Venue).filter_by(city=city).all()]
-    } for city in citydata]
-  return render_template('pages/venues.html', areas=data)
+      'num_upcoming_shows': showcounts.get(venue.id, 0)
+      } for venue in byarea.get((area.state, area.city), [])[:per_area]]
+    } for area in areadata]
+  return render_template('pages/venues.html', areas=data, state=state, city=city, page=page,
+                         previous_cursor=encode_cursor(*areadata[0]) if has_previous else None,
+                         next_cursor=encode_cursor(*areadata[-1]) if has_next else None)
 
 
 @app.route('/venues/search', methods=['POST'])
+@query_budget(2)
 def search_venues():
   # TODO: implement search on artists with partial string search. Ensure it is case-insensitive.
   # seach for Hop should return "The Musical Hop".
   # search for "Music" should return "The Musical Hop" and "Park Square Live Music & Coffee"
-  searchterm = request.form.get('search_term')
-  searchresults = Venue.query.filter(Venue.name.ilike('%' + searchterm + '%')).all()
-  response={
-    "count": len(searchresults),
-    "data": [{
-      "id": searchresult.id,
-      "name": searchresult.name,
-      'num_upcoming_shows': (db.session.execute(ShowDetails.select().where(ShowDetails.c.venue_id==searchresult.id).where(ShowDetails.c.start_time > str(datetime.now())))).rowcount
-    } for searchresult in searchresults]
-  }
+  searchterm = request.form.get('search_term', '')
+  page = max(request.form.get('page', 1, type=int), 1)
+  response = search_page(Venue, ShowDetails.c.venue_id, searchterm, page)
   return render_template('pages/search_venues.html', results=response, search_term=request.form.get('search_term', ''))
 
 
-@app.route('/venues/<int:venue_id>')
-def show_venue(venue_id):
-  # shows the venue page with the given venue_id
-  # TODO: replace with real venue data from the venues table, using venue_id
-  #pastshowdata = db.session.execute(ShowDetails.select().where(ShowDetails.c.venue_id==venue_id).where(ShowDetails.c.start_time < str(datetime.now())))
-  #upcomingshowdata = db.session.execute(ShowDetails.select().where(ShowDetails.c.venue_id==venue_id).where(ShowDetails.c.start_time > str(datetime.now())))
-  pastshowdata = list(set(db.session.query(ShowDetails).join(Venue, ShowDetails.c.venue_id==venue_id).filter(ShowDetails.c.start_time < str(datetime.now())).all()))
-  upcomingshowdata = list(set(db.session.query(ShowDetails).join(Venue, ShowDetails.c.venue_id==venue_id).filter(ShowDetails.c.start_time > str(datetime.now())).all()))
-  venuedata = Venue.query.get(venue_id)
+def venue_page_data(venuedata, pastshowdata, upcomingshowdata, artists, matches=()):
   def convertolist(genres):
     return list(genres.split(' '))
   data={
@@ -171,79 +986,155 @@ def show_venue(venue_id):
     "image_link": venuedata.image_link,
     "past_shows": [{
       "artist_id": show.artist_id,
-      "artist_name": (Artist.query.filter_by(id=show.artist_id).one()).name,
-      "artist_image_link": (Artist.query.filter_by(id=show.artist_id).one()).image_link,
+      "artist_name": artists[show.artist_id].name,
+      "artist_image_link": artists[show.artist_id].image_link,
       "start_time": show.start_time
     } for show in pastshowdata],
     "upcoming_shows": [{
       "artist_id": show.artist_id,
-      "artist_name": (Artist.query.filter_by(id=show.artist_id).one()).name,
-      "artist_image_link": (Artist.query.filter_by(id=show.artist_id).one()).image_link,
+      "artist_name": artists[show.artist_id].name,
+      "artist_image_link": artists[show.artist_id].image_link,
       "start_time": show.start_time
     } for show in upcomingshowdata],
     "past_shows_count": len(pastshowdata),
-    "upcoming_shows_count": len(upcomingshowdata)  
+    "upcoming_shows_count": len(upcomingshowdata),
+    "matches": [{
+      "id": artist.id,
+      "name": artist.name,
+      "city": artist.city,
+      "state": artist.state,
+      "image_link": artist.image_link
+    } for artist in matches]
   }
+  return data
+
+@app.route('/venues/<int:venue_id>')
+@query_budget(5)
+def show_venue(venue_id):
+  # shows the venue page with the given venue_id
+  # TODO: replace with real venue data from the venues table, using venue_id
+  #pastshowdata = db.session.execute(ShowDetails.select().where(ShowDetails.c.venue_id==venue_id).where(ShowDetails.c.start_time < str(datetime.now())))
+  #upcomingshowdata = db.session.execute(ShowDetails.select().where(ShowDetails.c.venue_id==venue_id).where(ShowDetails.c.start_time > str(datetime.now())))
+  venuedata = Venue.query.filter_by(id=venue_id, deleted_at=None).first_or_404()
+  liveshows = db.session.query(ShowDetails.c.artist_id, ShowDetails.c.start_time).filter(ShowDetails.c.venue_id == venue_id)
+  # shows older than the retention window live in the archive, not in showdetails
+  pastshowdata = liveshows.filter(ShowDetails.c.start_time < datetime.now()).all() + archived_shows('venue_id', venue_id)
+  upcomingshowdata = liveshows.filter(ShowDetails.c.start_time > datetime.now()).all()
+  artists = artist_cache.get_many(show.artist_id for show in pastshowdata + upcomingshowdata)
+  pastshowdata = [show for show in pastshowdata if show.artist_id in artists]
+  upcomingshowdata = [show for show in upcomingshowdata if show.artist_id in artists]
+  matches = db.session.execute(match_list('venue', venue_id)).fetchall()
+  data = venue_page_data(venuedata, pastshowdata, upcomingshowdata, artists, matches)
   return render_template('pages/show_venue.html', venue=data)
 
+def parse_local_datetime(value):
+  # show times are stored as naive local time; an explicit offset is converted to it
+  parsed = dateutil.parser.parse(value)
+  if parsed.tzinfo is not None:
+    parsed = parsed.astimezone().replace(tzinfo=None)
+  return parsed
+
+@app.route('/venues/<int:venue_id>/availability')
+@query_budget(2)
+def venue_availability(venue_id):
+  # free windows for a venue between ?from= and ?to= (defaults to the next 30 days)
+  Venue.query.filter_by(id=venue_id, deleted_at=None).first_or_404()
+  try:
+    start = parse_local_datetime(request.args['from']) if request.args.get('from') else datetime.now()
+    end = parse_local_datetime(request.args['to']) if request.args.get('to') else start + timedelta(days=30)
+  except (ValueError, OverflowError):
+    abort(400)
+  if end <= start:
+    abort(400)
+  # a single range scan on ix_showdetails_venue_id_start_time; no show is longer
+  # than MAX_SHOW_DURATION so nothing starting earlier can reach into the window
+  earliest = start - timedelta(minutes=app.config['MAX_SHOW_DURATION'])
+  shows = db.session.query(ShowDetails.c.start_time, ShowDetails.c.duration).filter(
+    ShowDetails.c.venue_id == venue_id,
+    ShowDetails.c.start_time > earliest,
+    ShowDetails.c.start_time < end
+  ).order_by(ShowDetails.c.start_time).all()
+  booked = []
+  free = []
+  cursor = start
+  for show in shows:
+    show_end = show.start_time + timedelta(minutes=show.duration)
+    if show_end <= start:
+      continue
+    booked.append({'start': show.start_time.isoformat(), 'end': show_end.isoformat()})
+    if show.start_time > cursor:
+      free.append({'start': cursor.isoformat(), 'end': show.start_time.isoformat()})
+    cursor = max(cursor, show_end)
+  if cursor < end:
+    free.append({'start': cursor.isoformat(), 'end': end.isoformat()})
+  return jsonify({
+    'venue_id': venue_id,
+    'from': start.isoformat(),
+    'to': end.isoformat(),
+    'booked': booked,
+    'free': free
+  })
+
 #  Create Venue
 #  ----------------------------------------------------------------
 
 @app.route('/venues/create', methods=['GET'])
+@query_budget(0)
 def create_venue_form():
   form = VenueForm()
   return render_template('forms/new_venue.html', form=form)
 
 @app.route('/venues/create', methods=['POST'])
+@query_budget(16)
 def create_venue_submission():
+  def removebraces(genre):
+    remove = ' '
+    return (remove.join(genre))
+  data = {
+    'name' : request.form['name'],
+    'city' : request.form['city'],
+    'state' : request.form['state'],
+    'address' : request.form['address'],
+    'phone' : request.form['phone'],
+    'image_link' : request.form['image_link'],
+    'facebook_link' : request.form['facebook_link'],
+    'genres' : removebraces(request.form.getlist('genres')),
+    'genre_mask' : genre_mask(removebraces(request.form.getlist('genres'))),
+    'seeking_talent' : request.form['seeking_talent'],
+    'seeking_description' : request.form['seeking_description'],
+    'website' : request.form['website'],
+    'idempotency_key' : request.form.get('idempotency_key')
+  }
   try:
-    def removebraces(genre):
-      remove = ' '
-      return (remove.join(genre))
-    data = Venue(
-      name=request.form['name'],
-      city=request.form['city'],
-      state=request.form['state'],
-      address=request.form['address'],
-      phone=request.form['phone'],
-      image_link=request.form['image_link'],
-      facebook_link=request.form['facebook_link'],
-      genres=removebraces(request.form.getlist('genres')),
-      seeking_talent=request.form['seeking_talent'],
-      seeking_description=request.form['seeking_description'],
-      website=request.form['website']
-    )
-    db.session.add(data)
+    venue_id = insert_returning_id(Venue, data)
+    update_matches('venue', venue_id)
     db.session.commit()
-    flash('Venue ' + request.form['name'] + ' was successfully listed!')
-  except():
+  except exc.SQLAlchemyError:
     db.session.rollback()
-    flash('An error occurred. Venue ' + data.name + ' could not be listed.')
+    flash('An error occurred. Venue ' + data['name'] + ' could not be listed.')
+    return render_template('pages/home.html')
   finally:
     db.session.close()
-  # TODO: insert form data as a new Venue record in the db, instead
-  # TODO: modify data to be the data object returned from db insertion
-
-  # on successful db insert, flash success
-  #flash('Venue ' + request.form['name'] + ' was successfully listed!')
-  # TODO: on unsuccessful db insert, flash an error instead.
-  # e.g., flash('An error occurred. Venue ' + data.name + ' could not be listed.')
-  # see: http://flask.pocoo.org/docs/1.0/patterns/flashing/
-  return render_template('pages/home.html')
+  flash('Venue ' + data['name'] + ' was successfully listed!')
+  return redirect(url_for('show_venue', venue_id=venue_id))
 
 @app.route('/venues/<venue_id>/delete', methods=['DELETE'])
+@query_budget(18)
 def delete_venue(venue_id):
   # TODO: Complete this endpoint for taking a venue_id, and using
   # SQLAlchemy ORM to delete a record. Handle cases where the session commit could fail.
 
   # BONUS CHALLENGE: Implement a button to delete a Venue on a Venue Page, have it so that
   # clicking that button delete it from the db then redirect the user to the homepage
+  # the venue is only flagged here; its shows and the row itself are removed
+  # in small batches by the background purger
   error = False
   try:
-    venue = Venue.query.get(venue_id)
-    db.session.delete(venue)
+    venue = Venue.query.filter_by(id=venue_id, deleted_at=None).first_or_404()
+    venue.deleted_at = datetime.now()
+    update_matches('venue', venue.id)
     db.session.commit()
-  except():
+  except exc.SQLAlchemyError:
     db.session.rollback()
     error = True
   finally:
@@ -251,47 +1142,92 @@ def delete_venue(venue_id):
   if error:
     abort(500)
   else:
+    broadcast_invalidation('venue', venue_id)
+    broadcast_counterpart_invalidation('venue', venue_id)
+    wake_purger()
     return jsonify({'success': True})
   #return render_template('pages/home.html')
 
 #  Artists
 #  ----------------------------------------------------------------
+ARTIST_LETTERS = [chr(code) for code in range(ord('A'), ord('Z') + 1)] + ['#']
+
+def artist_letter_counts():
+  # live artists per letter bucket, grouped off ix_artists_live_initial_name and
+  # cached per worker; creates, edits and deletes broadcast an invalidation
+  def build():
+    counts = dict.fromkeys(ARTIST_LETTERS, 0)
+    rows = db.session.query(artist_initial, func.count()).filter(Artist.deleted_at.is_(None)).group_by(artist_initial).all()
+    for initial, count in rows:
+      counts[initial if initial in ARTIST_LETTERS[:-1] else '#'] += count
+    return counts
+  return artist_letter_cache.get(build)
+
+def encode_cursor(*key):
+  # opaque keyset cursor for a page boundary, e.g. (name, id) or (state, city)
+  return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+  if not cursor:
+    return None
+  try:
+    first, second = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+  except (ValueError, TypeError, UnicodeError):
+    abort(400)
+  return first, second
+
 @app.route('/artists')
+@query_budget(2)
 def artists():
-  # TODO: replace with real data returned from querying the database
-  artists = Artist.query.all()
+  # ?letter= picks an A-Z or '#' bucket; ?after= / ?before= are keyset cursors on
+  # (name, id), so every page is an index range scan however deep it is
+  counts = artist_letter_counts()
+  letter = request.args.get('letter', '').upper()
+  if letter not in counts:
+    letter = next((bucket for bucket in ARTIST_LETTERS if counts[bucket]), 'A')
+  per_page = app.config['ARTISTS_PER_PAGE']
+  after = decode_cursor(request.args.get('after'))
+  before = decode_cursor(request.args.get('before'))
+
+  # a column projection returns plain immutable rows, skipping ORM instances and the identity map
+  query = db.session.query(Artist.id, Artist.name).filter(Artist.deleted_at.is_(None))
+  if letter == '#':
+    query = query.filter(artist_initial.notin_(ARTIST_LETTERS[:-1]))
+  else:
+    query = query.filter(artist_initial == letter)
+  if before is not None:
+    artists = query.filter(tuple_(Artist.name, Artist.id) < before).order_by(
+      Artist.name.desc(), Artist.id.desc()).limit(per_page + 1).all()
+    has_previous, has_next = len(artists) > per_page, True
+    artists = artists[:per_page][::-1]
+  else:
+    if after is not None:
+      query = query.filter(tuple_(Artist.name, Artist.id) > after)
+    artists = query.order_by(Artist.name, Artist.id).limit(per_page + 1).all()
+    has_previous, has_next = after is not None, len(artists) > per_page
+    artists = artists[:per_page]
+
   data=[{
     "id": artist.id,
     "name": artist.name,
   } for artist in artists ]
-  return render_template('pages/artists.html', artists=data)
+  return render_template('pages/artists.html', artists=data, letter=letter,
+                         letters=[(bucket, counts[bucket]) for bucket in ARTIST_LETTERS],
+                         previous_cursor=encode_cursor(artists[0].name, artists[0].id) if artists and has_previous else None,
+                         next_cursor=encode_cursor(artists[-1].name, artists[-1].id) if artists and has_next else None)
 
 @app.route('/artists/search', methods=['POST'])
+@query_budget(2)
 def search_artists():
   # TODO: implement search on artists with partial string search. Ensure it is case-insensitive.
   # seach for "A" should return "Guns N Petals", "Matt Quevado", and "The Wild Sax Band".
   # search for "band" should return "The Wild Sax Band".
-  searchterm = request.form.get('search_term')
-  searchresults = Artist.query.filter(Artist.name.ilike('%' + searchterm + '%')).all()
-  response={
-    "count": len(searchresults),
-    "data": [{
-      "id": searchresult.id,
-      "name": searchresult.name,
-      "num_upcoming_shows": (db.session.execute(ShowDetails.select().where(ShowDetails.c.artist_id==searchresult.id).where(ShowDetails.c.start_time > str(datetime.now())))).rowcount
-    } for searchresult in searchresults]
-  }  
+  searchterm = request.form.get('search_term', '')
+  page = max(request.form.get('page', 1, type=int), 1)
+  response = search_page(Artist, ShowDetails.c.artist_id, searchterm, page)
   return render_template('pages/search_artists.html', results=response, search_term=request.form.get('search_term', ''))
 
-@app.route('/artists/<int:artist_id>')
-def show_artist(artist_id):
-  # shows the venue page with the given venue_id
-  # TODO: replace with real venue data from the venues table, using venue_id
-  #pastshowdata = db.session.execute(ShowDetails.select().where(ShowDetails.c.artist_id==artist_id).where(ShowDetails.c.start_time < str(datetime.now())))
-  #upcomingshowdata = db.session.execute(ShowDetails.select().where(ShowDetails.c.artist_id==artist_id).where(ShowDetails.c.start_time > str(datetime.now())))
-  pastshowdata = list(set(db.session.query(ShowDetails).join(Artist, ShowDetails.c.artist_id==artist_id).filter(ShowDetails.c.start_time < str(datetime.now())).all()))
-  upcomingshowdata = list(set(db.session.query(ShowDetails).join(Artist, ShowDetails.c.artist_id==artist_id).filter(ShowDetails.c.start_time > str(datetime.now())).all()))
-  artistdata = Artist.query.get(artist_id)
+def artist_page_data(artistdata, pastshowdata, upcomingshowdata, venues, similar=(), matches=()):
   def convertolist(genres):
     return list(genres.split(' '))
   data={
@@ -308,27 +1244,65 @@ def show_artist(artist_id):
     "image_link": artistdata.image_link,
     "past_shows": [{
       "venue_id": show.venue_id,
-      "venue_name": (Venue.query.filter_by(id=show.venue_id).one()).name,
-      "venue_image_link": (Venue.query.filter_by(id=show.venue_id).one()).image_link,
+      "venue_name": venues[show.venue_id].name,
+      "venue_image_link": venues[show.venue_id].image_link,
       "start_time": show.start_time
     } for show in pastshowdata],
     "upcoming_shows": [{
       "venue_id": show.venue_id,
-      "venue_name": (Venue.query.filter_by(id=show.venue_id).one()).name,
-      "venue_image_link": (Venue.query.filter_by(id=show.venue_id).one()).image_link,
+      "venue_name": venues[show.venue_id].name,
+      "venue_image_link": venues[show.venue_id].image_link,
       "start_time": show.start_time
     } for show in upcomingshowdata],
     "past_shows_count": len(pastshowdata),
-    "upcoming_shows_count": len(upcomingshowdata)
+    "upcoming_shows_count": len(upcomingshowdata),
+    "similar_artists": [{
+      "id": artist.id,
+      "name": artist.name,
+      "image_link": artist.image_link
+    } for artist in similar],
+    "matches": [{
+      "id": venue.id,
+      "name": venue.name,
+      "city": venue.city,
+      "state": venue.state,
+      "image_link": venue.image_link
+    } for venue in matches]
   }
+  return data
+
+def similar_artists(artist_id):
+  # live "fans also like" artists, best first, off the similar_artists primary key
+  return db.select([Artist.id, Artist.name, Artist.image_link]).select_from(
+    SimilarArtists.join(Artist, Artist.id == SimilarArtists.c.similar_id)).where(
+    SimilarArtists.c.artist_id == artist_id).where(Artist.deleted_at.is_(None)).order_by(SimilarArtists.c.rank)
+
+@app.route('/artists/<int:artist_id>')
+@query_budget(6)
+def show_artist(artist_id):
+  # shows the venue page with the given venue_id
+  # TODO: replace with real venue data from the venues table, using venue_id
+  #pastshowdata = db.session.execute(ShowDetails.select().where(ShowDetails.c.artist_id==artist_id).where(ShowDetails.c.start_time < str(datetime.now())))
+  #upcomingshowdata = db.session.execute(ShowDetails.select().where(ShowDetails.c.artist_id==artist_id).where(ShowDetails.c.start_time > str(datetime.now())))
+  artistdata = Artist.query.filter_by(id=artist_id, deleted_at=None).first_or_404()
+  liveshows = db.session.query(ShowDetails.c.venue_id, ShowDetails.c.start_time).filter(ShowDetails.c.artist_id == artist_id)
+  pastshowdata = liveshows.filter(ShowDetails.c.start_time < datetime.now()).all() + archived_shows('artist_id', artist_id)
+  upcomingshowdata = liveshows.filter(ShowDetails.c.start_time > datetime.now()).all()
+  venues = venue_cache.get_many(show.venue_id for show in pastshowdata + upcomingshowdata)
+  pastshowdata = [show for show in pastshowdata if show.venue_id in venues]
+  upcomingshowdata = [show for show in upcomingshowdata if show.venue_id in venues]
+  similar = db.session.execute(similar_artists(artist_id)).fetchall()
+  matches = db.session.execute(match_list('artist', artist_id)).fetchall()
+  data = artist_page_data(artistdata, pastshowdata, upcomingshowdata, venues, similar, matches)
   return render_template('pages/show_artist.html', artist=data)
 
 #  Update
 #  ----------------------------------------------------------------
 @app.route('/artists/<int:artist_id>/edit', methods=['GET'])
+@query_budget(1)
 def edit_artist(artist_id):
   form = ArtistForm()
-  artistdata = Artist.query.get(artist_id)
+  artistdata = Artist.query.filter_by(id=artist_id, deleted_at=None).first_or_404()
   def convertolist(genres):
     return list(genres.split(' '))
   artist={
@@ -348,39 +1322,47 @@ def edit_artist(artist_id):
   return render_template('forms/edit_artist.html', form=form, artist=artist)
 
 @app.route('/artists/<int:artist_id>/edit', methods=['POST'])
+@query_budget(17)
 def edit_artist_submission(artist_id):
-  # TODO: take values from the form submitted, and update existing
-  # artist record with ID <artist_id> using the new attributes
+  def removebraces(genre):
+    remove = ' '
+    return (remove.join(genre))
+  data={
+    'name' : request.form['name'],
+    'city' : request.form['city'],
+    'state' : request.form['state'],
+    'phone' : request.form['phone'],
+    'image_link' : request.form['image_link'],
+    'facebook_link' : request.form['facebook_link'],
+    'genres' : removebraces(request.form.getlist('genres')),
+    'genre_mask' : genre_mask(removebraces(request.form.getlist('genres'))),
+    'seeking_venue' : request.form['seeking_venue'],
+    'seeking_description' : request.form['seeking_description'],
+    'website' : request.form['website']
+  }
   try:
-    def removebraces(genre):
-      remove = ' '
-      return (remove.join(genre))
-    data={
-      'name' : request.form['name'],
-      'city' : request.form['city'],
-      'state' : request.form['state'],
-      'phone' : request.form['phone'],
-      'image_link' : request.form['image_link'],
-      'facebook_link' : request.form['facebook_link'],
-      'genres' : removebraces(request.form.getlist('genres')),
-      'seeking_venue' : request.form['seeking_venue'],
-      'seeking_description' : request.form['seeking_description'],
-      'website' : request.form['website']
-    }
-    db.session.query(Artist).filter_by(id=artist_id).update(data)
+    updated = update_returning_id(Artist, artist_id, data)
+    if updated is not None:
+      update_matches('artist', updated)
     db.session.commit()
-    flash('Artist ' + request.form['name'] + ' was successfully updated!')
-  except():
+  except exc.SQLAlchemyError:
     db.session.rollback()
-    flash('An error occurred. ' + data.name + ' could not be updated.')
+    updated = None
   finally:
     db.session.close()
+  if updated is None:
+    flash('An error occurred. ' + data['name'] + ' could not be updated.')
+  else:
+    broadcast_invalidation('artist', artist_id)
+    broadcast_counterpart_invalidation('artist', artist_id)
+    flash('Artist ' + data['name'] + ' was successfully updated!')
   return redirect(url_for('show_artist', artist_id=artist_id))
 
 @app.route('/venues/<int:venue_id>/edit', methods=['GET'])
+@query_budget(1)
 def edit_venue(venue_id):
   form = VenueForm()
-  venuedata = Venue.query.get(venue_id)
+  venuedata = Venue.query.filter_by(id=venue_id, deleted_at=None).first_or_404()
   def convertolist(genres):
     return list(genres.split(' '))
   venue={
@@ -401,83 +1383,92 @@ def edit_venue(venue_id):
   return render_template('forms/edit_venue.html', form=form, venue=venue)
 
 @app.route('/venues/<int:venue_id>/edit', methods=['POST'])
+@query_budget(17)
 def edit_venue_submission(venue_id):
+  def removebraces(genre):
+    remove = ' '
+    return (remove.join(genre))
+  data = {
+    'name' : request.form['name'],
+    'city' : request.form['city'],
+    'state' : request.form['state'],
+    'address' : request.form['address'],
+    'phone' : request.form['phone'],
+    'image_link' : request.form['image_link'],
+    'facebook_link' : request.form['facebook_link'],
+    'genres' : removebraces(request.form.getlist('genres')),
+    'genre_mask' : genre_mask(removebraces(request.form.getlist('genres'))),
+    'seeking_talent' : request.form['seeking_talent'],
+    'seeking_description' : request.form['seeking_description'],
+    'website' : request.form['website']
+  }
   try:
-    def removebraces(genre):
-      remove = ' '
-      return (remove.join(genre))
-    data = {
-      'name' : request.form['name'],
-      'city' : request.form['city'],
-      'state' : request.form['state'],
-      'address' : request.form['address'],
-      'phone' : request.form['phone'],
-      'image_link' : request.form['image_link'],
-      'facebook_link' : request.form['facebook_link'],
-      'genres' : removebraces(request.form.getlist('genres')),
-      'seeking_talent' : request.form['seeking_talent'],
-      'seeking_description' : request.form['seeking_description'],
-      'website' : request.form['website']
-    }
-    db.session.query(Venue).filter_by(id=venue_id).update(data)
+    updated = update_returning_id(Venue, venue_id, data)
+    if updated is not None:
+      update_matches('venue', updated)
     db.session.commit()
-    flash('Venue ' + request.form['name'] + ' was successfully updated!')
-  except():
+  except exc.SQLAlchemyError:
     db.session.rollback()
-    flash('An error occurred. ' + data.name + ' could not be updated.')
+    updated = None
   finally:
     db.session.close()
-  # TODO: take values from the form submitted, and update existing
-  # venue record with ID <venue_id> using the new attributes
+  if updated is None:
+    flash('An error occurred. ' + data['name'] + ' could not be updated.')
+  else:
+    broadcast_invalidation('venue', venue_id)
+    broadcast_counterpart_invalidation('venue', venue_id)
+    flash('Venue ' + data['name'] + ' was successfully updated!')
   return redirect(url_for('show_venue', venue_id=venue_id))
 
 #  Create Artist
 #  ----------------------------------------------------------------
 
 @app.route('/artists/create', methods=['GET'])
+@query_budget(0)
 def create_artist_form():
   form = ArtistForm()
   return render_template('forms/new_artist.html', form=form)
 
 @app.route('/artists/create', methods=['POST'])
+@query_budget(16)
 def create_artist_submission():
+  # called upon submitting the new artist listing form
+  def removebraces(genre):
+    remove = ' '
+    return (remove.join(genre))
+  data = {
+    'name' : request.form['name'],
+    'city' : request.form['city'],
+    'state' : request.form['state'],
+    'phone' : request.form['phone'],
+    'image_link' : request.form['image_link'],
+    'facebook_link' : request.form['facebook_link'],
+    'genres' : removebraces(request.form.getlist('genres')),
+    'genre_mask' : genre_mask(removebraces(request.form.getlist('genres'))),
+    'seeking_venue' : request.form['seeking_venue'],
+    'seeking_description' : request.form['seeking_description'],
+    'website' : request.form['website'],
+    'idempotency_key' : request.form.get('idempotency_key')
+  }
   try:
-    def removebraces(genre):
-      remove = ' '
-      return (remove.join(genre))
-    data = Artist(
-      name = request.form['name'],
-      city = request.form['city'],
-      state = request.form['state'],
-      phone = request.form['phone'],
-      image_link = request.form['image_link'],
-      facebook_link = request.form['facebook_link'],
-      genres = removebraces(request.form.getlist('genres')),
-      seeking_venue = request.form['seeking_venue'],
-      seeking_description = request.form['seeking_description'],
-      website = request.form['website']
-    )
-    db.session.add(data)
+    artist_id = insert_returning_id(Artist, data)
+    update_matches('artist', artist_id)
     db.session.commit()
-    flash('Artist ' + request.form['name'] + ' was successfully listed!')
-  except():
+    # refreshes the /artists letter counts in every worker
+    broadcast_invalidation('artist', artist_id)
+  except exc.SQLAlchemyError:
     db.session.rollback()
-    flash('An error occurred. Artist ' + data.name + ' could not be listed.')
+    flash('An error occurred. Artist ' + data['name'] + ' could not be listed.')
+    return render_template('pages/home.html')
   finally:
     db.session.close()
-  # called upon submitting the new artist listing form
-  # TODO: insert form data as a new Venue record in the db, instead
-  # TODO: modify data to be the data object returned from db insertion
-
-  # on successful db insert, flash success
-  #flash('Artist ' + request.form['name'] + ' was successfully listed!')
-  # TODO: on unsuccessful db insert, flash an error instead.
-  # e.g., flash('An error occurred. Artist ' + data.name + ' could not be listed.')
-  return render_template('pages/home.html')
+  flash('Artist ' + data['name'] + ' was successfully listed!')
+  return redirect(url_for('show_artist', artist_id=artist_id))
 
 # Delete Artist
 # ------------------------------------------------------------
 @app.route('/artists/<artist_id>/delete', methods=['DELETE'])
+@query_budget(18)
 def delete_artist(artist_id):
   # TODO: Complete this endpoint for taking a venue_id, and using
   # SQLAlchemy ORM to delete a record. Handle cases where the session commit could fail.
@@ -486,10 +1477,11 @@ def delete_artist(artist_id):
   # clicking that button delete it from the db then redirect the user to the homepage
   error = False
   try:
-    artist = Artist.query.get(artist_id)
-    db.session.delete(artist)
+    artist = Artist.query.filter_by(id=artist_id, deleted_at=None).first_or_404()
+    artist.deleted_at = datetime.now()
+    update_matches('artist', artist.id)
     db.session.commit()
-  except():
+  except exc.SQLAlchemyError:
     db.session.rollback()
     error = True
   finally:
@@ -497,6 +1489,9 @@ def delete_artist(artist_id):
   if error:
     abort(500)
   else:
+    broadcast_invalidation('artist', artist_id)
+    broadcast_counterpart_invalidation('artist', artist_id)
+    wake_purger()
     return jsonify({'success': True})
   #return render_template('pages/home.html')
 
@@ -505,50 +1500,1120 @@ def delete_artist(artist_id):
 #  ----------------------------------------------------------------
 
 @app.route('/shows')
+@query_budget(3)
+@single_flight
 def shows():
   # displays list of shows at /shows
   # TODO: replace with real venues data.
   #       num_shows should be aggregated based on number of upcoming shows per venue.
-  shows = db.session.execute(ShowDetails.select())
+  shows = db.session.query(ShowDetails.c.venue_id, ShowDetails.c.artist_id, ShowDetails.c.start_time).all()
+  venues = venue_cache.get_many(show.venue_id for show in shows)
+  artists = artist_cache.get_many(show.artist_id for show in shows)
+  shows = [show for show in shows if show.venue_id in venues and show.artist_id in artists]
   data=[{
     "venue_id": show.venue_id,
-    "venue_name": (Venue.query.filter_by(id=show.venue_id).one()).name,
+    "venue_name": venues[show.venue_id].name,
     "artist_id": show.artist_id,
-    "artist_name": (Artist.query.filter_by(id=show.artist_id).one()).name,
-    "artist_image_link": (Artist.query.filter_by(id=show.artist_id).one()).image_link,
+    "artist_name": artists[show.artist_id].name,
+    "artist_image_link": artists[show.artist_id].image_link,
     "start_time": show.start_time
   } for show in shows ]
   
   return render_template('pages/shows.html', shows=data)
 
 @app.route('/shows/create')
+@query_budget(0)
 def create_shows():
   # renders form. do not touch.
   form = ShowForm()
   return render_template('forms/new_show.html', form=form)
 
+def booked_shows(venue_ids, artist_ids, earliest, latest):
+  # shows of any of the venues or artists starting between earliest and latest,
+  # read from the (venue_id|artist_id, start_time) indexes
+  return db.session.query(ShowDetails).filter(
+    or_(ShowDetails.c.venue_id.in_(venue_ids), ShowDetails.c.artist_id.in_(artist_ids)),
+    ShowDetails.c.start_time > earliest,
+    ShowDetails.c.start_time < latest
+  ).all()
+
+def find_booking_conflict(venue_id, artist_id, start_time, duration):
+  # returns an existing show that overlaps the requested slot for either the venue
+  # or the artist. Overlapping shows must start within MAX_SHOW_DURATION before the
+  # new slot, so this stays a bounded scan of the (venue_id|artist_id, start_time) indexes.
+  end_time = start_time + timedelta(minutes=duration)
+  earliest = start_time - timedelta(minutes=app.config['MAX_SHOW_DURATION'])
+  candidates = booked_shows([venue_id], [artist_id], earliest, end_time)
+  for show in candidates:
+    if show.start_time + timedelta(minutes=show.duration) > start_time:
+      return show
+  return None
+
+def live_show_parties(venue_ids, artist_ids):
+  # ('venue', id) / ('artist', id) for each id that exists and is not soft-deleted,
+  # from one IN (...) lookup
+  found = db.session.execute(union_all(
+    db.select([literal('venue').label('kind'), Venue.id]).where(Venue.id.in_(venue_ids)).where(Venue.deleted_at.is_(None)),
+    db.select([literal('artist').label('kind'), Artist.id]).where(Artist.id.in_(artist_ids)).where(Artist.deleted_at.is_(None))
+  )).fetchall()
+  return set((row.kind, row.id) for row in found)
+
 @app.route('/shows/create', methods=['POST'])
+@query_budget(8)
 def create_show_submission():
+  # called to create new shows in the db, upon submitting new show listing form
+  try:
+    venue_id = int(request.form['venue_id'])
+    artist_id = int(request.form['artist_id'])
+    start_time = parse_local_datetime(request.form['start_time'])
+    duration = int(request.form.get('duration') or app.config['DEFAULT_SHOW_DURATION'])
+  except (ValueError, OverflowError):
+    flash('An error occurred. Show could not be listed.')
+    return render_template('pages/home.html')
+  if duration < 1 or duration > app.config['MAX_SHOW_DURATION']:
+    flash('An error occurred. Show duration must be between 1 and ' + str(app.config['MAX_SHOW_DURATION']) + ' minutes.')
+    return render_template('pages/home.html')
+  found = live_show_parties([venue_id], [artist_id])
+  if ('venue', venue_id) not in found:
+    flash('An error occurred. Venue ' + str(venue_id) + ' does not exist.')
+    return render_template('pages/home.html')
+  if ('artist', artist_id) not in found:
+    flash('An error occurred. Artist ' + str(artist_id) + ' does not exist.')
+    return render_template('pages/home.html')
+  conflict = find_booking_conflict(venue_id, artist_id, start_time, duration)
+  if conflict is not None:
+    flash('An error occurred. The venue or artist is already booked at ' + format_datetime(conflict.start_time) + '.')
+    return render_template('pages/home.html')
   try:
-    data = ShowDetails.insert().values(venue_id = request.form['venue_id'], artist_id = request.form['artist_id'], start_time = request.form['start_time'])
+    data = ShowDetails.insert().values(venue_id = venue_id, artist_id = artist_id, start_time = start_time, duration = duration)
     db.session.execute(data)
+    update_popularity(added=[ShowSlot(venue_id, artist_id, start_time)])
     db.session.commit()
+    # both calendar feeds now miss this show
+    broadcast_invalidation('venue', venue_id)
+    broadcast_invalidation('artist', artist_id)
     flash('Show was successfully listed!')
-  except():
+  except exc.IntegrityError:
+    # the Postgres exclusion constraints catch overlaps that raced the check above
     db.session.rollback()
     flash('An error occurred. Show could not be listed.')
   finally:
     db.session.close()
-  # called to create new shows in the db, upon submitting new show listing form
-  # TODO: insert form data as a new Show record in the db, instead
-
-  # on successful db insert, flash success
-  #flash('Show was successfully listed!')
-  # TODO: on unsuccessful db insert, flash an error instead.
-  # e.g., flash('An error occurred. Show could not be listed.')
-  # see: http://flask.pocoo.org/docs/1.0/patterns/flashing/
   return render_template('pages/home.html')
 
+@app.route('/shows/create/batch')
+@query_budget(0)
+def create_shows_batch():
+  form = ShowBatchForm()
+  return render_template('forms/new_show_batch.html', form=form, results=None)
+
+@app.route('/shows/create/batch', methods=['POST'])
+@query_budget(8)
+def create_shows_batch_submission():
+  # schedules many shows at once, e.g. a whole tour. Rows come either as a JSON list of
+  # {artist_id, venue_id, start_time, duration} objects or as form lines of
+  # "artist_id, venue_id, start_time[, duration]". Either every row is listed, in one
+  # multi-row insert, or none is and each failing row is reported.
+  if request.is_json:
+    entries = request.get_json()
+    if not isinstance(entries, list):
+      abort(400)
+  else:
+    entries = [dict(zip(('artist_id', 'venue_id', 'start_time', 'duration'), [part.strip() for part in line.split(',')]))
+               for line in request.form.get('shows', '').splitlines() if line.strip()]
+  max_duration = app.config['MAX_SHOW_DURATION']
+  results = []
+  for entry in entries:
+    if not isinstance(entry, dict):
+      results.append({'artist_id': None, 'venue_id': None, 'start_time': None,
+                      'error': 'Expected an object with artist_id, venue_id, start_time[, duration].'})
+      continue
+    result = {'artist_id': entry.get('artist_id'), 'venue_id': entry.get('venue_id'), 'start_time': entry.get('start_time'), 'error': None}
+    try:
+      result['artist_id'] = int(entry['artist_id'])
+      result['venue_id'] = int(entry['venue_id'])
+      result['start_time'] = parse_local_datetime(str(entry['start_time']))
+      result['duration'] = int(entry.get('duration') or app.config['DEFAULT_SHOW_DURATION'])
+      if result['duration'] < 1 or result['duration'] > max_duration:
+        result['error'] = 'Duration must be between 1 and ' + str(max_duration) + ' minutes.'
+    except (KeyError, TypeError, ValueError, OverflowError):
+      result['error'] = 'Expected artist_id, venue_id, start_time[, duration].'
+    results.append(result)
+  valid = [result for result in results if result['error'] is None]
+
+  if valid:
+    # one IN (...) lookup for every referenced venue and artist
+    venue_ids = set(result['venue_id'] for result in valid)
+    artist_ids = set(result['artist_id'] for result in valid)
+    found = live_show_parties(venue_ids, artist_ids)
+    for result in valid:
+      if ('venue', result['venue_id']) not in found:
+        result['error'] = 'Venue ' + str(result['venue_id']) + ' does not exist.'
+      elif ('artist', result['artist_id']) not in found:
+        result['error'] = 'Artist ' + str(result['artist_id']) + ' does not exist.'
+    valid = [result for result in valid if result['error'] is None]
+
+  if valid:
+    # one query for every existing show that could overlap the batch; rows in the
+    # batch are checked against those and against each other
+    booked = booked_shows(
+      set(result['venue_id'] for result in valid),
+      set(result['artist_id'] for result in valid),
+      min(result['start_time'] for result in valid) - timedelta(minutes=max_duration),
+      max(result['start_time'] + timedelta(minutes=result['duration']) for result in valid)
+    )
+    slots = [(show.venue_id, show.artist_id, show.start_time, show.start_time + timedelta(minutes=show.duration)) for show in booked]
+    for result in valid:
+      start_time = result['start_time']
+      end_time = start_time + timedelta(minutes=result['duration'])
+      for venue_id, artist_id, booked_start, booked_end in slots:
+        if (venue_id == result['venue_id'] or artist_id == result['artist_id']) and booked_start < end_time and booked_end > start_time:
+          result['error'] = 'The venue or artist is already booked at ' + format_datetime(booked_start) + '.'
+          break
+      else:
+        slots.append((result['venue_id'], result['artist_id'], start_time, end_time))
+
+  failed = [result for result in results if result['error'] is not None]
+  if results and not failed:
+    try:
+      db.session.execute(ShowDetails.insert().values([{
+        'venue_id': result['venue_id'],
+        'artist_id': result['artist_id'],
+        'start_time': result['start_time'],
+        'duration': result['duration']
+      } for result in results]))
+      update_popularity(added=[ShowSlot(result['venue_id'], result['artist_id'], result['start_time']) for result in results])
+      db.session.commit()
+      broadcast_invalidation('venue', *set(result['venue_id'] for result in results))
+      broadcast_invalidation('artist', *set(result['artist_id'] for result in results))
+    except exc.IntegrityError:
+      # the Postgres exclusion constraints catch overlaps that raced the check above
+      db.session.rollback()
+      failed = results
+      for result in results:
+        result['error'] = 'The batch conflicted with a show booked concurrently; nothing was listed.'
+    finally:
+      db.session.close()
+  listed = 0 if failed else len(results)
+
+  if request.is_json:
+    return jsonify({
+      'listed': listed,
+      'results': [dict(result, start_time=str(result['start_time'])) for result in results]
+    }), 200 if listed or not results else 422
+  if listed:
+    flash(str(listed) + ' shows were successfully listed!')
+  elif results:
+    flash('An error occurred. ' + str(len(failed)) + ' of ' + str(len(results)) + ' shows could not be listed, so none were.')
+  return render_template('forms/new_show_batch.html', form=ShowBatchForm(request.form), results=results)
+
+# ----------------------------------------------------------------------------#
+# Calendar feeds.
+# ----------------------------------------------------------------------------#
+
+def ics_escape(value):
+  return (value or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+def ics_fold(line):
+  # content lines are at most 75 octets; continuations start with a space
+  folded = []
+  current = ''
+  for char in line:
+    if len((current + char).encode('utf-8')) > 75:
+      folded.append(current)
+      current = ' '
+    current += char
+  folded.append(current)
+  return '\r\n'.join(folded)
+
+def calendar_feed(kind, entity_id):
+  # upcoming shows of a venue or artist as an iCalendar feed, read with one range
+  # scan of the (venue_id|artist_id, start_time) index and cached until the next
+  # change to that entity, its shows or the venues/artists those shows pair it with
+  cache = calendar_caches[kind]
+  entry, generation = cache.get(entity_id)
+  if entry is None:
+    if kind == 'venue':
+      own_cache, other_cache = venue_cache, artist_cache
+      column, other_column = ShowDetails.c.venue_id, ShowDetails.c.artist_id
+    else:
+      own_cache, other_cache = artist_cache, venue_cache
+      column, other_column = ShowDetails.c.artist_id, ShowDetails.c.venue_id
+    entity = own_cache.get_many([entity_id]).get(entity_id)
+    if entity is None:
+      abort(404)
+    shows = db.session.query(ShowDetails.c.id, other_column.label('other_id'), ShowDetails.c.start_time, ShowDetails.c.duration).filter(
+      column == entity_id,
+      ShowDetails.c.start_time >= datetime.now()
+    ).order_by(ShowDetails.c.start_time).all()
+    others = other_cache.get_many(show.other_id for show in shows)
+
+    events = []
+    for show in shows:
+      if show.other_id not in others:
+        continue
+      venue, artist = (entity, others[show.other_id]) if kind == 'venue' else (others[show.other_id], entity)
+      events.append([
+        'BEGIN:VEVENT',
+        'UID:show-%d@fyyur' % show.id,
+        'DTSTART:' + show.start_time.strftime('%Y%m%dT%H%M%S'),
+        'DTEND:' + (show.start_time + timedelta(minutes=show.duration)).strftime('%Y%m%dT%H%M%S'),
+        'SUMMARY:' + ics_escape(artist.name + ' at ' + venue.name),
+        'LOCATION:' + ics_escape(venue.name),
+        'URL:' + url_for('show_artist' if kind == 'venue' else 'show_venue', _external=True,
+                         **{('artist_id' if kind == 'venue' else 'venue_id'): show.other_id}),
+        'END:VEVENT'
+      ])
+    # the ETag covers the events only, so every worker computes the same one
+    etag = hashlib.sha1(json.dumps([entity.name, events]).encode('utf-8')).hexdigest()
+    last_modified = datetime.utcnow().replace(microsecond=0)
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//Fyyur//Show calendar//EN',
+             'X-WR-CALNAME:' + ics_escape(entity.name)]
+    for event in events:
+      lines.extend(event[:2] + ['DTSTAMP:' + last_modified.strftime('%Y%m%dT%H%M%SZ')] + event[2:])
+    lines.append('END:VCALENDAR')
+    body = ''.join(ics_fold(line) + '\r\n' for line in lines)
+    entry = (body, etag, last_modified)
+    cache.put(entity_id, entry, generation)
+
+  body, etag, last_modified = entry
+  response = Response(body, mimetype='text/calendar')
+  response.set_etag(etag)
+  response.last_modified = last_modified
+  # clients keep their copy but revalidate it with If-None-Match / If-Modified-Since
+  response.cache_control.no_cache = True
+  return response.make_conditional(request)
+
+@app.route('/venues/<int:venue_id>/calendar.ics')
+@query_budget(3)
+def venue_calendar(venue_id):
+  return calendar_feed('venue', venue_id)
+
+@app.route('/artists/<int:artist_id>/calendar.ics')
+@query_budget(3)
+def artist_calendar(artist_id):
+  return calendar_feed('artist', artist_id)
+
+# ----------------------------------------------------------------------------#
+# Purging soft-deleted venues and artists.
+# ----------------------------------------------------------------------------#
+
+purge_wakeup = threading.Event()
+purge_lock = threading.Lock()
+purge_thread = None
+
+
+def purge_deleted():
+  # hard-deletes soft-deleted venues and artists. Their shows go first, PURGE_BATCH_SIZE
+  # rows per transaction with a short pause in between, so a busy venue never holds
+  # locks on a large slice of showdetails.
+  batch_size = app.config['PURGE_BATCH_SIZE']
+  purged = 0
+  for model, column in ((Venue, ShowDetails.c.venue_id), (Artist, ShowDetails.c.artist_id)):
+    deleted = db.session.query(model.id).filter(model.deleted_at.isnot(None))
+    while True:
+      shows = db.session.query(ShowDetails.c.id, ShowDetails.c.venue_id, ShowDetails.c.artist_id, ShowDetails.c.start_time).filter(
+        column.in_(deleted.subquery())).limit(batch_size).all()
+      ids = [show.id for show in shows]
+      if not ids:
+        break
+      db.session.execute(ShowDetails.delete().where(ShowDetails.c.id.in_(ids)))
+      update_popularity(removed=shows)
+      db.session.commit()
+      # the surviving side's feeds still list these shows until they are evicted
+      broadcast_invalidation('venue_calendar', *set(show.venue_id for show in shows))
+      broadcast_invalidation('artist_calendar', *set(show.artist_id for show in shows))
+      purged += len(ids)
+      time.sleep(app.config['PURGE_BATCH_PAUSE'])
+    while True:
+      ids = [row.id for row in deleted.limit(batch_size)]
+      if not ids:
+        break
+      db.session.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+      db.session.commit()
+  db.session.close()
+  return purged
+
+
+def purge_worker():
+  while True:
+    purge_wakeup.wait(app.config['PURGE_INTERVAL'])
+    purge_wakeup.clear()
+    with app.app_context():
+      try:
+        purge_deleted()
+      except exc.SQLAlchemyError:
+        db.session.rollback()
+        app.logger.exception('purging deleted venues and artists failed')
+
+
+def wake_purger():
+  global purge_thread
+  with purge_lock:
+    if purge_thread is None:
+      purge_thread = threading.Thread(target=purge_worker, name='purger', daemon=True)
+      purge_thread.start()
+  purge_wakeup.set()
+
+
+@app.cli.command('purge-deleted')
+def purge_deleted_command():
+  # flask purge-deleted: run one purge pass, e.g. from cron
+  print('Purged ' + str(purge_deleted()) + ' shows')
+
+# ----------------------------------------------------------------------------#
+# Show partitions and archive.
+# ----------------------------------------------------------------------------#
+
+# On Postgres showdetails is range-partitioned by month of start_time. Partitions
+# are created SHOW_PARTITIONS_AHEAD months in advance; those older than
+# SHOW_RETENTION_MONTHS are detached, written to SHOW_ARCHIVE_DIR as gzipped CSV
+# and dropped. Every export is also loaded into SHOW_ARCHIVE_DIR/index.sqlite, indexed
+# by venue and artist, and past-show lookups read their own rows from there for
+# anything no longer in the table.
+# Shows booked past the horizon land in showdetails_default; maintenance gives each
+# of their months its own partition and moves them there, so the default stays
+# empty between runs and every show ends up under the no-overlap constraints.
+
+ArchivedShow = namedtuple('ArchivedShow', [
+  'venue_id', 'venue_name', 'venue_image_link',
+  'artist_id', 'artist_name', 'artist_image_link',
+  'start_time', 'duration'])
+partition_name = re.compile(r'^showdetails_y(\d{4})m(\d{2})$')
+archive_state = threading.local()
+partition_lock = threading.Lock()
+partition_thread = None
+
+
+def add_months(month, count):
+  index = month.year * 12 + month.month - 1 + count
+  return datetime(index // 12, index % 12 + 1, 1)
+
+
+def create_show_partition(month):
+  name = 'showdetails_y%04dm%02d' % (month.year, month.month)
+  if db.session.execute(text('SELECT to_regclass(:name)'), {'name': name}).scalar() is not None:
+    return
+  bounds = {'start': month, 'end': add_months(month, 1)}
+  # CREATE ... PARTITION OF fails while the default partition holds rows of this
+  # month, so those are moved over with the default detached (in one transaction)
+  stranded = db.session.execute(text(
+    'SELECT 1 FROM showdetails_default WHERE start_time >= :start AND start_time < :end LIMIT 1'), bounds).first()
+  if stranded:
+    db.session.execute(text('ALTER TABLE showdetails DETACH PARTITION showdetails_default'))
+  db.session.execute(text(
+    "CREATE TABLE %s PARTITION OF showdetails FOR VALUES FROM ('%s') TO ('%s')"
+    % (name, month.isoformat(), add_months(month, 1).isoformat())))
+  # exclusion constraints cannot span a partitioned table, so each month enforces its own
+  for column in ('venue_id', 'artist_id'):
+    db.session.execute(text(
+      "ALTER TABLE %s ADD CONSTRAINT %s_%s_no_overlap EXCLUDE USING gist "
+      "(%s WITH =, tsrange(start_time, start_time + duration * interval '1 minute') WITH &&)"
+      % (name, name, column.split('_')[0], column)))
+  if stranded:
+    db.session.execute(text(
+      'INSERT INTO %s (id, venue_id, artist_id, start_time, duration) '
+      'SELECT id, venue_id, artist_id, start_time, duration FROM showdetails_default '
+      'WHERE start_time >= :start AND start_time < :end' % name), bounds)
+    db.session.execute(text(
+      'DELETE FROM showdetails_default WHERE start_time >= :start AND start_time < :end'), bounds)
+    db.session.execute(text('ALTER TABLE showdetails ATTACH PARTITION showdetails_default DEFAULT'))
+
+
+def show_partitions():
+  rows = db.session.execute(text(
+    "SELECT child.relname FROM pg_inherits "
+    "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+    "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+    "WHERE parent.relname = 'showdetails'")).fetchall()
+  partitions = {}
+  for row in rows:
+    match = partition_name.match(row.relname)
+    if match:
+      partitions[row.relname] = datetime(int(match.group(1)), int(match.group(2)), 1)
+  return partitions
+
+
+def detached_show_partitions():
+  # month tables left behind by a run that detached a partition and then failed
+  rows = db.session.execute(text(
+    "SELECT relname FROM pg_class WHERE relkind = 'r' AND relname LIKE 'showdetails\\_y%' "
+    "AND NOT EXISTS (SELECT 1 FROM pg_inherits WHERE pg_inherits.inhrelid = pg_class.oid)")).fetchall()
+  return sorted(row.relname for row in rows if partition_name.match(row.relname))
+
+
+def archive_show_partition(name, attached=True):
+  # export while the partition is still attached, so a failed export leaves its shows
+  # where the live queries find them. The SHARE lock only holds off writes to this
+  # old month; the detach and drop commit together with the export's snapshot.
+  db.session.execute(text('LOCK TABLE %s IN SHARE MODE' % name))
+  rows = db.session.execute(text(
+    "SELECT shows.venue_id, venues.name AS venue_name, venues.image_link AS venue_image_link, "
+    "shows.artist_id, artists.name AS artist_name, artists.image_link AS artist_image_link, "
+    "shows.start_time, shows.duration FROM %s AS shows "
+    "LEFT JOIN venues ON venues.id = shows.venue_id "
+    "LEFT JOIN artists ON artists.id = shows.artist_id "
+    "ORDER BY shows.start_time" % name))
+  directory = app.config['SHOW_ARCHIVE_DIR']
+  os.makedirs(directory, exist_ok=True)
+  path = os.path.join(directory, name + '.csv.gz')
+  with gzip.open(path + '.tmp', 'wt', newline='') as archive:
+    writer = csv.writer(archive)
+    writer.writerow(ArchivedShow._fields)
+    for row in rows:
+      writer.writerow([row.venue_id, row.venue_name, row.venue_image_link, row.artist_id, row.artist_name,
+                       row.artist_image_link, row.start_time.isoformat(), row.duration])
+  os.replace(path + '.tmp', path)
+  index_archive(name, replace=True)
+  if attached:
+    db.session.execute(text('ALTER TABLE showdetails DETACH PARTITION %s' % name))
+  db.session.execute(text('DROP TABLE %s' % name))
+  db.session.commit()
+
+
+def maintain_show_partitions():
+  if db.engine.dialect.name != 'postgresql':
+    return
+  this_month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+  months = set(add_months(this_month, ahead) for ahead in range(app.config['SHOW_PARTITIONS_AHEAD'] + 1))
+  months.update(row[0] for row in db.session.execute(text(
+    "SELECT DISTINCT date_trunc('month', start_time) FROM showdetails_default")))
+  for month in sorted(months):
+    try:
+      create_show_partition(month)
+      db.session.commit()
+    except exc.SQLAlchemyError:
+      # e.g. overlapping shows stranded in the default; the other months still go ahead
+      db.session.rollback()
+      app.logger.exception('creating the showdetails partition for %s failed', month.strftime('%Y-%m'))
+  cutoff = add_months(this_month, -app.config['SHOW_RETENTION_MONTHS'])
+  expired = [(name, True) for name, month in sorted(show_partitions().items()) if month < cutoff]
+  for name, attached in expired + [(name, False) for name in detached_show_partitions()]:
+    try:
+      archive_show_partition(name, attached)
+    except (exc.SQLAlchemyError, OSError, sqlite3.Error):
+      # the partition stays (attached or not) and the next run archives it again
+      db.session.rollback()
+      app.logger.exception('archiving %s failed', name)
+  db.session.close()
+
+
+def archive_index():
+  # per-thread connection to the archive index; reads are single indexed lookups
+  connection = getattr(archive_state, 'connection', None)
+  if connection is None or archive_state.pid != os.getpid():
+    connection = sqlite3.connect(os.path.join(app.config['SHOW_ARCHIVE_DIR'], 'index.sqlite'), timeout=5, isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('CREATE TABLE IF NOT EXISTS archived_shows (partition TEXT NOT NULL, venue_id INTEGER, venue_name TEXT, '
+                       'venue_image_link TEXT, artist_id INTEGER, artist_name TEXT, artist_image_link TEXT, '
+                       'start_time TEXT, duration INTEGER)')
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_archived_shows_venue_id ON archived_shows (venue_id, start_time)')
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_archived_shows_artist_id ON archived_shows (artist_id, start_time)')
+    connection.execute('CREATE TABLE IF NOT EXISTS archived_partitions (name TEXT PRIMARY KEY)')
+    archive_state.connection = connection
+    archive_state.pid = os.getpid()
+  return connection
+
+
+def index_archive(name, replace=False):
+  # copies one gzipped export into the index, once; replace=True reloads a partition
+  # whose export was written again by a retried archive run
+  connection = archive_index()
+  connection.execute('BEGIN IMMEDIATE')
+  try:
+    if replace:
+      connection.execute('DELETE FROM archived_shows WHERE partition = ?', (name,))
+      connection.execute('DELETE FROM archived_partitions WHERE name = ?', (name,))
+    if connection.execute('SELECT 1 FROM archived_partitions WHERE name = ?', (name,)).fetchone() is None:
+      with gzip.open(os.path.join(app.config['SHOW_ARCHIVE_DIR'], name + '.csv.gz'), 'rt', newline='') as archive:
+        rows = csv.reader(archive)
+        next(rows, None)
+        connection.executemany('INSERT INTO archived_shows VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', ([name] + row for row in rows))
+      connection.execute('INSERT INTO archived_partitions (name) VALUES (?)', (name,))
+    connection.execute('COMMIT')
+  except BaseException:
+    connection.execute('ROLLBACK')
+    raise
+
+
+def archived_shows(column, entity_id):
+  # archived shows for one venue or artist, newest first
+  directory = app.config['SHOW_ARCHIVE_DIR']
+  if not os.path.isdir(directory):
+    return []
+  connection = archive_index()
+  # exports written before the index existed, or copied in by hand, are indexed on first sight
+  exports = set(name[:-len('.csv.gz')] for name in os.listdir(directory) if name.endswith('.csv.gz'))
+  indexed = set(row[0] for row in connection.execute('SELECT name FROM archived_partitions'))
+  for name in sorted(exports - indexed):
+    index_archive(name)
+  rows = connection.execute(
+    'SELECT venue_id, venue_name, venue_image_link, artist_id, artist_name, artist_image_link, start_time, duration '
+    'FROM archived_shows WHERE %s = ? ORDER BY start_time DESC' % column, (entity_id,))
+  return [ArchivedShow(row[0], row[1], row[2], row[3], row[4], row[5], dateutil.parser.parse(row[6]), row[7])
+          for row in rows]
+
+
+def partition_worker():
+  while True:
+    with app.app_context():
+      try:
+        maintain_show_partitions()
+      except exc.SQLAlchemyError:
+        db.session.rollback()
+        app.logger.exception('maintaining showdetails partitions failed')
+    time.sleep(app.config['PARTITION_MAINTENANCE_INTERVAL'])
+
+
+@app.before_first_request
+def start_partition_maintenance():
+  global partition_thread
+  with partition_lock:
+    if partition_thread is None:
+      partition_thread = threading.Thread(target=partition_worker, name='partitions', daemon=True)
+      partition_thread.start()
+
+
+@app.cli.command('maintain-partitions')
+def maintain_partitions_command():
+  # flask maintain-partitions: create upcoming partitions and archive expired ones
+  maintain_show_partitions()
+
+# ----------------------------------------------------------------------------#
+# Popularity rankings.
+# ----------------------------------------------------------------------------#
+
+POPULARITY_WINDOWS = (7, 30, 90)
+ShowSlot = namedtuple('ShowSlot', ['venue_id', 'artist_id', 'start_time'])
+popularity_lock = threading.Lock()
+popularity_thread = None
+
+
+def popularity_deltas(shows, old_as_of, new_as_of):
+  # {(table, id): [change to shows_7d, shows_30d, shows_90d]} from counting the shows
+  # at new_as_of instead of old_as_of; None stands for not counted at all
+  deltas = {}
+  for show in shows:
+    for index, days in enumerate(POPULARITY_WINDOWS):
+      window = timedelta(days=days)
+      was = old_as_of is not None and old_as_of <= show.start_time < old_as_of + window
+      now = new_as_of is not None and new_as_of <= show.start_time < new_as_of + window
+      if was != now:
+        for table, entity_id in ((VenuePopularity, show.venue_id), (ArtistPopularity, show.artist_id)):
+          deltas.setdefault((table, int(entity_id)), [0] * len(POPULARITY_WINDOWS))[index] += now - was
+  return deltas
+
+
+def apply_popularity_deltas(deltas):
+  # one upsert per table (Postgres and SQLite >= 3.24 share the syntax)
+  for table in (VenuePopularity, ArtistPopularity):
+    key = table.primary_key.columns.values()[0].name
+    rows = [dict(id=entity_id, d7=change[0], d30=change[1], d90=change[2])
+            for (delta_table, entity_id), change in deltas.items() if delta_table is table]
+    if rows:
+      db.session.execute(text(
+        'INSERT INTO {table} ({key}, shows_7d, shows_30d, shows_90d) VALUES (:id, :d7, :d30, :d90) '
+        'ON CONFLICT ({key}) DO UPDATE SET shows_7d = {table}.shows_7d + excluded.shows_7d, '
+        'shows_30d = {table}.shows_30d + excluded.shows_30d, shows_90d = {table}.shows_90d + excluded.shows_90d'
+        .format(table=table.name, key=key)), rows)
+
+
+def update_popularity(added=(), removed=()):
+  # call inside the transaction that inserts or deletes the shows. The shared row
+  # lock on popularity_state keeps the refresh job from sliding the windows meanwhile.
+  if not added and not removed:
+    return
+  as_of = db.session.query(PopularityState.c.as_of).with_for_update(read=True).scalar()
+  if as_of is None:
+    # nothing is counted until the first refresh builds the tables
+    return
+  deltas = popularity_deltas(added, None, as_of)
+  for (table, entity_id), change in popularity_deltas(removed, as_of, None).items():
+    total = deltas.setdefault((table, entity_id), [0] * len(POPULARITY_WINDOWS))
+    for index, value in enumerate(change):
+      total[index] += value
+  apply_popularity_deltas(deltas)
+
+
+def refresh_popularity():
+  # slides every window from the stored as_of to now: only shows that started since,
+  # or that came within n days since, change a count. Without a state row the
+  # tables are built from scratch.
+  now = datetime.now()
+  as_of = db.session.query(PopularityState.c.as_of).with_for_update().scalar()
+  columns = (ShowDetails.c.venue_id, ShowDetails.c.artist_id, ShowDetails.c.start_time)
+  if as_of is None:
+    db.session.execute(VenuePopularity.delete())
+    db.session.execute(ArtistPopularity.delete())
+    shows = db.session.query(*columns).filter(
+      ShowDetails.c.start_time >= now,
+      ShowDetails.c.start_time < now + timedelta(days=max(POPULARITY_WINDOWS))).all()
+    db.session.execute(PopularityState.insert().values(id=1, as_of=now))
+  elif as_of < now:
+    slices = [and_(ShowDetails.c.start_time >= as_of, ShowDetails.c.start_time < now)]
+    for days in POPULARITY_WINDOWS:
+      slices.append(and_(ShowDetails.c.start_time >= as_of + timedelta(days=days),
+                         ShowDetails.c.start_time < now + timedelta(days=days)))
+    shows = db.session.query(*columns).filter(or_(*slices)).all()
+    db.session.execute(PopularityState.update().values(as_of=now))
+  else:
+    db.session.rollback()
+    return 0
+  apply_popularity_deltas(popularity_deltas(shows, as_of, now))
+  # rows whose widest window is empty carry no ranking
+  db.session.execute(VenuePopularity.delete().where(VenuePopularity.c.shows_90d <= 0))
+  db.session.execute(ArtistPopularity.delete().where(ArtistPopularity.c.shows_90d <= 0))
+  db.session.commit()
+  return len(shows)
+
+
+def popular(kind, days, limit, offset=0):
+  # top entities for one window, read newest-first off ix_<kind>_popularity_shows_<n>d
+  table, model = (VenuePopularity, Venue) if kind == 'venue' else (ArtistPopularity, Artist)
+  key = table.primary_key.columns.values()[0]
+  shows = table.c['shows_%dd' % days]
+  return db.session.query(model.id, model.name, model.city, model.state, model.image_link, shows.label('shows')).join(
+    table, key == model.id).filter(model.deleted_at.is_(None), shows > 0).order_by(
+    shows.desc(), key.desc()).limit(limit).offset(offset).all()
+
+
+def popularity_window():
+  days = request.args.get('window', 30, type=int)
+  if days not in POPULARITY_WINDOWS:
+    abort(400)
+  return days
+
+
+def popularity_worker():
+  while True:
+    with app.app_context():
+      try:
+        refresh_popularity()
+      except exc.SQLAlchemyError:
+        db.session.rollback()
+        app.logger.exception('refreshing popularity rankings failed')
+      finally:
+        db.session.close()
+    time.sleep(app.config['POPULARITY_REFRESH_INTERVAL'])
+
+
+@app.before_first_request
+def start_popularity_refresh():
+  global popularity_thread
+  with popularity_lock:
+    if popularity_thread is None:
+      popularity_thread = threading.Thread(target=popularity_worker, name='popularity', daemon=True)
+      popularity_thread.start()
+
+
+@app.cli.command('refresh-popularity')
+def refresh_popularity_command():
+  # flask refresh-popularity: slide the popularity windows up to now
+  print('Re-counted ' + str(refresh_popularity()) + ' shows')
+
+
+@app.route('/api/venues/popular')
+@query_budget(1)
+def api_popular_venues():
+  days = popularity_window()
+  limit = min(max(request.args.get('limit', 10, type=int), 1), 100)
+  return jsonify({'window': days, 'venues': [
+    {'id': venue.id, 'name': venue.name, 'shows': venue.shows} for venue in popular('venue', days, limit)]})
+
+
+@app.route('/api/artists/popular')
+@query_budget(1)
+def api_popular_artists():
+  days = popularity_window()
+  limit = min(max(request.args.get('limit', 10, type=int), 1), 100)
+  return jsonify({'window': days, 'artists': [
+    {'id': artist.id, 'name': artist.name, 'shows': artist.shows} for artist in popular('artist', days, limit)]})
+
+
+@app.route('/api/venues/<int:venue_id>/popularity')
+@query_budget(1)
+def api_venue_popularity(venue_id):
+  row = db.session.query(Venue.id, VenuePopularity).outerjoin(VenuePopularity, VenuePopularity.c.venue_id == Venue.id).filter(
+    Venue.id == venue_id, Venue.deleted_at.is_(None)).first_or_404()
+  return jsonify(dict({'venue_id': venue_id}, **{'shows_%dd' % days: getattr(row, 'shows_%dd' % days) or 0 for days in POPULARITY_WINDOWS}))
+
+
+@app.route('/api/artists/<int:artist_id>/popularity')
+@query_budget(1)
+def api_artist_popularity(artist_id):
+  row = db.session.query(Artist.id, ArtistPopularity).outerjoin(ArtistPopularity, ArtistPopularity.c.artist_id == Artist.id).filter(
+    Artist.id == artist_id, Artist.deleted_at.is_(None)).first_or_404()
+  return jsonify(dict({'artist_id': artist_id}, **{'shows_%dd' % days: getattr(row, 'shows_%dd' % days) or 0 for days in POPULARITY_WINDOWS}))
+
+# ----------------------------------------------------------------------------#
+# Similar artists.
+# ----------------------------------------------------------------------------#
+
+# Offline job, e.g. nightly from cron. Each live artist is a row of genre and venue
+# features, L2-normalised so that a dot product is a cosine similarity. Genres are
+# few and shared by most artists, so that part is a dense matrix product; venues
+# are sparse and their scores are added on top. Scores are computed for a block of
+# artists against everyone, as large as fits SIMILAR_ARTISTS_BLOCK_BYTES, and only
+# each row's best k leave the block. Needs numpy and scipy (requirements-similar.txt).
+
+
+def normalize_rows(matrix):
+  norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+  norms[norms == 0] = 1
+  return sparse.diags(1 / norms) @ matrix
+
+
+def build_similar_artists():
+  if np is None or sparse is None:
+    raise RuntimeError('building similar artists needs numpy and scipy; see requirements-similar.txt')
+  k = app.config['SIMILAR_ARTISTS_K']
+  min_score = app.config['SIMILAR_ARTISTS_MIN_SCORE']
+  genre_weight = app.config['SIMILAR_ARTISTS_GENRE_WEIGHT']
+
+  artists = db.session.query(Artist.id, Artist.genre_mask).filter(Artist.deleted_at.is_(None)).order_by(Artist.id).all()
+  ids = np.array([artist.id for artist in artists], dtype=np.int64)
+  position = {artist_id: index for index, artist_id in enumerate(ids.tolist())}
+
+  # artist x genre, one column per MATCH_GENRES entry, read off the genre_mask bits
+  # so that a multi-word genre such as 'Rock n Roll' is a single feature
+  rows, columns = [], []
+  for index, artist in enumerate(artists):
+    for bit in mask_bits(artist.genre_mask):
+      rows.append(index)
+      columns.append(bit)
+  genres = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)),
+                             shape=(len(ids), len(MATCH_GENRES)))
+
+  # artist x venue, weighted by log(1 + shows played there)
+  played = [row for row in db.session.query(ShowDetails.c.artist_id, ShowDetails.c.venue_id, func.count()).group_by(
+    ShowDetails.c.artist_id, ShowDetails.c.venue_id) if row[0] in position]
+  venue_columns = {}
+  venues = sparse.csr_matrix((
+    np.log1p(np.array([row[2] for row in played], dtype=np.float32)),
+    ([position[row[0]] for row in played], [venue_columns.setdefault(row[1], len(venue_columns)) for row in played])
+  ), shape=(len(ids), max(len(venue_columns), 1)))
+
+  features = normalize_rows(sparse.hstack([
+    normalize_rows(genres) * np.sqrt(genre_weight),
+    normalize_rows(venues) * np.sqrt(1 - genre_weight)
+  ]).tocsr()).astype(np.float32).tocsr()
+  genre_part = np.ascontiguousarray(features[:, :genres.shape[1]].toarray())
+  venue_part = features[:, genres.shape[1]:].tocsr()
+  venue_transposed = venue_part.T.tocsr()
+
+  # a block holds a float32 score and an int64 argpartition index per artist pair
+  block = max(1, app.config['SIMILAR_ARTISTS_BLOCK_BYTES'] // (12 * max(len(ids), 1)))
+  best = min(k, len(ids) - 1)
+  stored = 0
+  for start in range(0, len(ids), block):
+    stop = min(start + block, len(ids))
+    scores = genre_part[start:stop] @ genre_part.T
+    shared = (venue_part[start:stop] @ venue_transposed).tocoo()
+    scores[shared.row, shared.col] += shared.data
+    # negated in place: with this many tied scores argpartition finds the k
+    # smallest an order of magnitude faster than the k largest
+    np.negative(scores, out=scores)
+    scores[np.arange(stop - start), np.arange(start, stop)] = np.inf
+    db.session.execute(SimilarArtists.delete().where(SimilarArtists.c.artist_id.in_(ids[start:stop].tolist())))
+    if best > 0:
+      # best k per row, unordered (ties at the k-th place go to whichever artist
+      # argpartition picks), then ranked by score descending and the lower id
+      column = np.argpartition(scores, best - 1, axis=1)[:, :best]
+      score = -np.take_along_axis(scores, column, axis=1)
+      order = np.lexsort((column, -score), axis=1)
+      column, score = np.take_along_axis(column, order, axis=1), np.take_along_axis(score, order, axis=1)
+      row, rank = np.nonzero(score >= min_score)
+      if len(row):
+        db.session.execute(SimilarArtists.insert(), [
+          {'artist_id': int(ids[start + r]), 'rank': int(q), 'similar_id': int(ids[column[r, q]]), 'score': float(score[r, q])}
+          for r, q in zip(row, rank)])
+      stored += len(row)
+    # one short transaction per block; pages keep reading the previous list meanwhile
+    db.session.commit()
+
+  # soft-deleted artists keep no list of their own
+  db.session.execute(SimilarArtists.delete().where(SimilarArtists.c.artist_id.in_(
+    db.session.query(Artist.id).filter(Artist.deleted_at.isnot(None)).subquery())))
+  db.session.commit()
+  db.session.close()
+  return stored
+
+
+@app.cli.command('build-similar-artists')
+def build_similar_artists_command():
+  # flask build-similar-artists: recompute every artist's "fans also like" list
+  print('Stored ' + str(build_similar_artists()) + ' similar artist pairs')
+
+# ----------------------------------------------------------------------------#
+# Matching.
+# ----------------------------------------------------------------------------#
+
+# Venues seeking talent are paired with artists seeking venues in the same state
+# that share at least one genre. Genres are a bitset (genre_mask), so a pair's
+# score is popcount arithmetic: shared / combined genres, plus MATCH_SAME_CITY_BONUS
+# in the same city. Candidates come off the ix_*_seeking_state_city indexes with
+# the mask AND evaluated in SQL, and are then posted under each (state, genre bit)
+# they have, so an owner only scores the counterparts sharing one of its genres.
+# Each side keeps its top MATCHES_PER_ENTITY list in venue_matches / artist_matches;
+# a list shorter than that holds every candidate, which lets update_matches()
+# patch the lists touched by one write instead of rebuilding them.
+
+# bit i of genre_mask is MATCH_GENRES[i]: append new genres, never reorder, since
+# stored masks (and the add_matching migration) depend on the positions
+MATCH_GENRES = [
+  'Alternative', 'Blues', 'Classical', 'Country', 'Electronic', 'Folk', 'Funk', 'Hip-Hop',
+  'Heavy Metal', 'Instrumental', 'Jazz', 'Musical Theatre', 'Pop', 'Punk', 'R&B', 'Reggae',
+  'Rock n Roll', 'Soul', 'Other'
+]
+
+# kind -> (model, seeking column, its match table, the other kind)
+MATCH_SIDES = {
+  'venue': (Venue, Venue.seeking_talent, VenueMatches, 'artist'),
+  'artist': (Artist, Artist.seeking_venue, ArtistMatches, 'venue')
+}
+
+
+def genre_mask(genres):
+  # genres are stored space separated and some contain spaces themselves
+  padded = ' %s ' % (genres or '').lower()
+  return sum(1 << bit for bit, genre in enumerate(MATCH_GENRES) if ' %s ' % genre.lower() in padded)
+
+
+def seeking_rows(kind):
+  model, seeking = MATCH_SIDES[kind][:2]
+  return db.session.query(model.id, model.city, model.state, model.genre_mask).filter(
+    seeking == 'True', model.deleted_at.is_(None))
+
+
+def mask_bits(mask):
+  return [bit for bit in range((mask or 0).bit_length()) if mask >> bit & 1]
+
+
+def match_score(one, other):
+  if one.state != other.state:
+    return None
+  shared = bin((one.genre_mask or 0) & (other.genre_mask or 0)).count('1')
+  if not shared:
+    return None
+  score = shared / bin(one.genre_mask | other.genre_mask).count('1')
+  if (one.city or '').strip().lower() == (other.city or '').strip().lower():
+    score += app.config['MATCH_SAME_CITY_BONUS']
+  return score
+
+
+def match_candidates(kind, owners):
+  # seeking counterparts for several owners in one query
+  other = MATCH_SIDES[kind][3]
+  model = MATCH_SIDES[other][0]
+  mask = 0
+  for owner in owners:
+    mask |= owner.genre_mask or 0
+  if not mask:
+    return []
+  return seeking_rows(other).filter(
+    model.state.in_({owner.state for owner in owners}),
+    model.genre_mask.op('&')(literal(mask, db.BigInteger)) != 0).all()
+
+
+def write_match_lists(kind, owner_ids, owners, candidates):
+  # replaces the lists of owner_ids; those missing from owners (no longer seeking) end up empty
+  table, other = MATCH_SIDES[kind][2:]
+  postings = {}
+  for candidate in candidates:
+    for bit in mask_bits(candidate.genre_mask):
+      postings.setdefault((candidate.state, bit), []).append(candidate)
+  rows = []
+  for owner in owners:
+    sharing = {}
+    for bit in mask_bits(owner.genre_mask):
+      for candidate in postings.get((owner.state, bit), ()):
+        sharing[candidate.id] = candidate
+    scored = []
+    for candidate in sharing.values():
+      score = match_score(owner, candidate)
+      if score is not None:
+        scored.append((-score, candidate.id))
+    rows.extend({kind + '_id': owner.id, other + '_id': candidate_id, 'score': -score}
+                for score, candidate_id in sorted(scored)[:app.config['MATCHES_PER_ENTITY']])
+  db.session.execute(table.delete().where(table.c[kind + '_id'].in_(list(owner_ids))))
+  if rows:
+    db.session.execute(table.insert(), rows)
+  return len(rows)
+
+
+def rebuild_match_lists(kind, owner_ids):
+  owners = seeking_rows(kind).filter(MATCH_SIDES[kind][0].id.in_(list(owner_ids))).all()
+  return write_match_lists(kind, owner_ids, owners, match_candidates(kind, owners))
+
+
+def update_matches(kind, entity_id):
+  # call in the transaction that created, edited or deleted the venue/artist
+  other = MATCH_SIDES[kind][3]
+  table = MATCH_SIDES[other][2]
+  owner, entry = table.c[other + '_id'], table.c[kind + '_id']
+  limit = app.config['MATCHES_PER_ENTITY']
+
+  entity = seeking_rows(kind).filter(MATCH_SIDES[kind][0].id == entity_id).first()
+  candidates = match_candidates(kind, [entity]) if entity is not None else []
+  write_match_lists(kind, [entity_id], [entity] if entity is not None else [], candidates)
+
+  # take the entity out of the other side's lists, then put it back where it now ranks
+  listed = dict(db.session.query(owner, table.c.score).filter(entry == entity_id).all())
+  if listed:
+    db.session.execute(table.delete().where(entry == entity_id))
+  scores = {}
+  for candidate in candidates:
+    score = match_score(candidate, entity)
+    if score is not None:
+      scores[candidate.id] = score
+  owners = set(listed) | set(scores)
+  if not owners:
+    return
+  sizes = {row[0]: (row[1], row[2]) for row in db.session.query(owner, func.count(), func.min(table.c.score)).filter(
+    owner.in_(owners)).group_by(owner)}
+  refill, inserts, overfull = [], [], []
+  for owner_id in owners:
+    size, worst = sizes.get(owner_id, (0, None))
+    score = scores.get(owner_id)
+    if owner_id in listed and size == limit - 1 and (score is None or score < listed[owner_id]):
+      # the list was full: a counterpart just below it may now outrank the entity
+      refill.append(owner_id)
+    elif score is not None and (size < limit or score >= worst):
+      inserts.append({other + '_id': owner_id, kind + '_id': entity_id, 'score': score})
+      if size >= limit:
+        overfull.append(owner_id)
+  if inserts:
+    db.session.execute(table.insert(), inserts)
+  if overfull:
+    rows = {}
+    for row in db.session.query(owner, entry, table.c.score).filter(owner.in_(overfull)):
+      rows.setdefault(row[0], []).append((-row[2], row[1]))
+    dropped = [(owner_id, entry_id) for owner_id, entries in rows.items() for score, entry_id in sorted(entries)[limit:]]
+    if dropped:
+      db.session.execute(table.delete().where(tuple_(owner, entry).in_(dropped)))
+  if refill:
+    rebuild_match_lists(other, refill)
+
+
+def rebuild_matches():
+  # every list from scratch, one state per transaction; `flask rebuild-matches`
+  stored = 0
+  for kind, (model, seeking, table, other) in MATCH_SIDES.items():
+    db.session.execute(table.delete().where(table.c[kind + '_id'].notin_(
+      db.session.query(model.id).filter(seeking == 'True', model.deleted_at.is_(None)).subquery())))
+    db.session.commit()
+    states = [row[0] for row in seeking_rows(kind).with_entities(model.state).distinct()]
+    for state in states:
+      owners = seeking_rows(kind).filter(model.state == state).all()
+      stored += write_match_lists(kind, [owner.id for owner in owners], owners, match_candidates(kind, owners))
+      db.session.commit()
+  db.session.close()
+  return stored
+
+
+@app.cli.command('rebuild-matches')
+def rebuild_matches_command():
+  # flask rebuild-matches: recompute every venue and artist match list
+  print('Stored ' + str(rebuild_matches()) + ' matches')
+
+
+def match_list(kind, entity_id):
+  # the entity's matches, best first, off ix_<kind>_matches_<kind>_id_score
+  table, other = MATCH_SIDES[kind][2:]
+  model = MATCH_SIDES[other][0]
+  score = table.c.score
+  return db.select([model.id, model.name, model.city, model.state, model.image_link, score]).select_from(
+    table.join(model, model.id == table.c[other + '_id'])).where(
+    table.c[kind + '_id'] == entity_id).where(model.deleted_at.is_(None)).order_by(score.desc(), model.id)
+
+
+@app.route('/api/venues/<int:venue_id>/matches')
+@query_budget(1)
+def api_venue_matches(venue_id):
+  return jsonify({'venue_id': venue_id, 'artists': [
+    dict(artist) for artist in db.session.execute(match_list('venue', venue_id))]})
+
+
+@app.route('/api/artists/<int:artist_id>/matches')
+@query_budget(1)
+def api_artist_matches(artist_id):
+  return jsonify({'artist_id': artist_id, 'venues': [
+    dict(venue) for venue in db.session.execute(match_list('artist', artist_id))]})
+
+# ----------------------------------------------------------------------------#
+# Home page feed.
+# ----------------------------------------------------------------------------#
+
+home_feed = None
+home_feed_wakeup = threading.Event()
+home_feed_lock = threading.Lock()
+home_feed_thread = None
+
+
+def build_home_feed():
+  size = app.config['HOME_FEED_SIZE']
+  venues = db.session.query(Venue.id, Venue.name, Venue.city, Venue.state, Venue.image_link).filter(
+    Venue.deleted_at.is_(None)).order_by(Venue.id.desc()).limit(size).all()
+  artists = db.session.query(Artist.id, Artist.name, Artist.city, Artist.state, Artist.image_link).filter(
+    Artist.deleted_at.is_(None)).order_by(Artist.id.desc()).limit(size).all()
+  shows = db.session.query(
+    ShowDetails.c.venue_id,
+    Venue.name.label('venue_name'),
+    ShowDetails.c.artist_id,
+    Artist.name.label('artist_name'),
+    Artist.image_link.label('artist_image_link'),
+    ShowDetails.c.start_time
+  ).select_from(ShowDetails).join(Venue, Venue.id == ShowDetails.c.venue_id).join(Artist, Artist.id == ShowDetails.c.artist_id).filter(
+    ShowDetails.c.start_time > datetime.now(), Venue.deleted_at.is_(None), Artist.deleted_at.is_(None)
+  ).order_by(ShowDetails.c.start_time).limit(size).all()
+  db.session.close()
+  return {
+    'venues': [dict(zip(venue.keys(), venue)) for venue in venues],
+    'artists': [dict(zip(artist.keys(), artist)) for artist in artists],
+    'upcoming_shows': [dict(zip(show.keys(), show)) for show in shows],
+    'built_at': datetime.now()
+  }
+
+
+def home_feed_worker():
+  global home_feed
+  while True:
+    with app.app_context():
+      try:
+        home_feed = build_home_feed()
+      except exc.SQLAlchemyError:
+        db.session.rollback()
+        app.logger.exception('rebuilding the home page feed failed')
+    home_feed_wakeup.wait(app.config['HOME_FEED_INTERVAL'])
+    home_feed_wakeup.clear()
+
+
+def wake_home_feed(rebuild=True):
+  # starts the refresher on first use; rebuild=True asks for a fresh snapshot now
+  global home_feed_thread
+  with home_feed_lock:
+    if home_feed_thread is None:
+      home_feed_thread = threading.Thread(target=home_feed_worker, name='home-feed', daemon=True)
+      home_feed_thread.start()
+  if rebuild:
+    home_feed_wakeup.set()
+
+
+# the views whose writes can change what the feed shows; searches are POSTs too
+HOME_FEED_WRITERS = {
+  'create_venue_submission', 'edit_venue_submission', 'delete_venue',
+  'create_artist_submission', 'edit_artist_submission', 'delete_artist',
+  'create_show_submission', 'create_shows_batch_submission'
+}
+
+
+@app.after_request
+def refresh_home_feed_after_write(response):
+  if request.endpoint in HOME_FEED_WRITERS and response.status_code < 400:
+    wake_home_feed()
+  return response
+
+
 @app.errorhandler(404)
 def not_found_error(error):
     return render_template('errors/404.html'), 404
@@ -558,16 +2623,152 @@ def server_error(error):
     return render_template('errors/500.html'), 500
 
 
+# ----------------------------------------------------------------------------#
+# Logging.
+# ----------------------------------------------------------------------------#
+
+
+class JSONFormatter(Formatter):
+  def format(self, record):
+    return json.dumps({
+      'time': datetime.fromtimestamp(record.created).isoformat(),
+      'level': record.levelname,
+      'message': record.getMessage(),
+      'request_id': getattr(record, 'request_id', None),
+      'endpoint': getattr(record, 'endpoint', None),
+      'latency_ms': getattr(record, 'latency_ms', None),
+      'sql_count': getattr(record, 'sql_count', None),
+      'location': '%s:%d' % (record.pathname, record.lineno)
+    }, default=str)
+
+
+class RequestQueueHandler(QueueHandler):
+  # hands records to the writer thread without ever blocking the request thread;
+  # when the queue is full the record is dropped and counted instead
+  def __init__(self, log_queue):
+    super().__init__(log_queue)
+    self.dropped = 0
+
+  def prepare(self, record):
+    record = super().prepare(record)
+    if has_request_context():
+      record.request_id = g.get('request_id')
+      record.endpoint = request.endpoint
+      if 'request_start' in g:
+        record.latency_ms = round((time.time() - g.request_start) * 1000, 3)
+      record.sql_count = len(g.get('sql_statements', []))
+    return record
+
+  def enqueue(self, record):
+    try:
+      self.queue.put_nowait(record)
+    except queue.Full:
+      self.dropped += 1
+
+
+@app.before_request
+def start_request_log():
+  g.request_start = time.time()
+  g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+
+
+@app.after_request
+def log_request(response):
+  response.headers['X-Request-ID'] = g.request_id
+  # ?profile= carries the admin PROFILE_TOKEN and must not reach the log
+  args = [(key, value) for key, value in request.args.items(multi=True) if key != 'profile']
+  path = request.path + ('?' + urlencode(args) if args else '')
+  app.logger.info('%s %s %s', request.method, path, response.status_code)
+  return response
+
+
+queue_handler = None
 if not app.debug:
-    file_handler = FileHandler('error.log')
-    file_handler.setFormatter(
-        Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]')
-    )
+    log_queue = queue.Queue(maxsize=app.config['LOG_QUEUE_SIZE'])
+    queue_handler = RequestQueueHandler(log_queue)
+    file_handler = WatchedFileHandler('error.log')
+    file_handler.setFormatter(JSONFormatter())
     app.logger.setLevel(logging.INFO)
     file_handler.setLevel(logging.INFO)
-    app.logger.addHandler(file_handler)
+    queue_handler.setLevel(logging.INFO)
+    log_listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    app.logger.removeHandler(default_handler)
+    app.logger.addHandler(queue_handler)
     app.logger.info('errors')
 
+# ----------------------------------------------------------------------------#
+# Rate limiting.
+# ----------------------------------------------------------------------------#
+
+def take_token(endpoint, client, capacity, refill_rate):
+  # token bucket per (endpoint, client): capacity tokens at most, refilled at
+  # refill_rate per second. Returns 0 when a token was taken, otherwise the
+  # seconds until the next one is due.
+  connection = local_store()
+  key = endpoint + ':' + client
+  now = time.time()
+  connection.execute('BEGIN IMMEDIATE')
+  try:
+    row = connection.execute('SELECT tokens, updated FROM rate_limit_buckets WHERE key = ?', (key,)).fetchone()
+    tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * refill_rate)
+    wait = 0 if tokens >= 1 else (1 - tokens) / refill_rate
+    if not wait:
+      tokens -= 1
+    connection.execute('INSERT OR REPLACE INTO rate_limit_buckets (key, tokens, updated) VALUES (?, ?, ?)', (key, tokens, now))
+    connection.execute('INSERT OR IGNORE INTO rate_limit_counters (endpoint) VALUES (?)', (endpoint,))
+    connection.execute('UPDATE rate_limit_counters SET {0} = {0} + 1 WHERE endpoint = ?'.format(
+      'rejected' if wait else 'allowed'), (endpoint,))
+    if random.random() < 0.001:
+      # buckets idle this long have refilled completely and can be forgotten
+      connection.execute('DELETE FROM rate_limit_buckets WHERE updated < ?', (now - app.config['RATE_LIMIT_IDLE'],))
+    connection.execute('COMMIT')
+  except BaseException:
+    connection.execute('ROLLBACK')
+    raise
+  return wait
+
+
+@app.before_request
+def enforce_rate_limit():
+  # RATE_LIMITS maps endpoints to (burst, tokens per second) for each client address
+  limit = app.config['RATE_LIMITS'].get(request.endpoint)
+  if limit is None:
+    return
+  try:
+    wait = take_token(request.endpoint, request.remote_addr or '-', *limit)
+  except sqlite3.Error:
+    # a stuck store must not take the site down with it
+    app.logger.exception('rate limit store unavailable; letting the request through')
+    return
+  if wait:
+    app.logger.warning('rate limited %s %s', request.remote_addr, request.endpoint)
+    raise TooManyRequests(retry_after=int(math.ceil(wait)))
+
+
+@app.route('/metrics')
+def metrics():
+  # Prometheus text format
+  lines = ['# HELP fyyur_rate_limit_requests_total Requests checked against RATE_LIMITS, by outcome.',
+           '# TYPE fyyur_rate_limit_requests_total counter']
+  for endpoint, allowed, rejected in local_store().execute(
+      'SELECT endpoint, allowed, rejected FROM rate_limit_counters ORDER BY endpoint'):
+    lines.append('fyyur_rate_limit_requests_total{endpoint="%s",outcome="allowed"} %d' % (endpoint, allowed))
+    lines.append('fyyur_rate_limit_requests_total{endpoint="%s",outcome="rejected"} %d' % (endpoint, rejected))
+  # the template counters belong to the worker that served this request
+  lines += ['# HELP fyyur_template_bytecode_cache_total Template loads by bytecode cache outcome.',
+            '# TYPE fyyur_template_bytecode_cache_total counter',
+            'fyyur_template_bytecode_cache_total{outcome="hit"} %d' % template_bytecode_cache.hits,
+            'fyyur_template_bytecode_cache_total{outcome="miss"} %d' % template_bytecode_cache.misses,
+            '# HELP fyyur_template_compile_seconds_total Time spent compiling templates.',
+            '# TYPE fyyur_template_compile_seconds_total counter',
+            'fyyur_template_compile_seconds_total %.6f' % template_bytecode_cache.compile_seconds,
+            '# HELP fyyur_log_records_dropped_total Log records dropped because the log queue was full.',
+            '# TYPE fyyur_log_records_dropped_total counter',
+            'fyyur_log_records_dropped_total %d' % (queue_handler.dropped if queue_handler is not None else 0)]
+  return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
 #----------------------------------------------------------------------------#
 # Launch.
 #----------------------------------------------------------------------------#
@@ -0,0 +1,69 @@
+"""Benchmark full ORM rows against column projections for the listing queries.
+
+Loads --rows artists into an in-memory SQLite database and compares
+Artist.query.all() with db.session.query(Artist.id, Artist.name).all(), the
+projection used by /artists and the search endpoints. Reports CPU time and
+peak memory per 10k rows.
+
+    python bench_projections.py --rows 100000
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+
+import config
+
+config.SQLALCHEMY_DATABASE_URI = 'sqlite://'
+
+from app import app, db, Artist  # noqa: E402
+
+
+def measure(load, repeat):
+    timings = []
+    peaks = []
+    for _ in range(repeat):
+        db.session.expunge_all()
+        gc.collect()
+        tracemalloc.start()
+        started = time.process_time()
+        rows = load()
+        timings.append(time.process_time() - started)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        del rows
+    return min(timings), min(peaks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.create_all()
+        db.session.execute(Artist.__table__.insert(), [{
+            'name': 'Artist %d' % i, 'city': 'San Francisco', 'state': 'CA', 'phone': '415-000-0000',
+            'genres': 'Jazz Blues', 'image_link': 'https://example.com/%d.jpg' % i,
+            'facebook_link': 'https://facebook.com/%d' % i, 'website': 'https://example.com',
+            'seeking_venue': 'True', 'seeking_description': 'Looking for venues'
+        } for i in range(args.rows)])
+        db.session.commit()
+
+        per = 10000.0 / args.rows
+        results = [
+            ('ORM objects', measure(lambda: Artist.query.filter(Artist.deleted_at.is_(None)).all(), args.repeat)),
+            ('projection', measure(lambda: db.session.query(Artist.id, Artist.name).filter(
+                Artist.deleted_at.is_(None)).all(), args.repeat)),
+        ]
+        print('%-12s %14s %16s' % ('', 'ms / 10k rows', 'KiB / 10k rows'))
+        for label, (cpu, peak) in results:
+            print('%-12s %14.1f %16.0f' % (label, cpu * 1000 * per, peak / 1024.0 * per))
+        (orm_cpu, orm_peak), (projection_cpu, projection_peak) = results[0][1], results[1][1]
+        print('saved        %13.1f%% %15.1f%%' % (
+            100 * (1 - projection_cpu / orm_cpu), 100 * (1 - projection_peak / float(orm_peak))))
+
+
+if __name__ == '__main__':
+    main()
@@ -44,6 +44,11 @@ def heroku_test():
     )
 
 
+def precompile():
+    # fills the local template cache; on heroku the Procfile does this on each dyno
+    local("FLASK_APP=app.py flask precompile-templates")
+
+
 def deploy():
     pull()
     test()
@@ -1,7 +1,8 @@
+import uuid
 from datetime import datetime
 from flask_wtf import Form
-from wtforms import StringField, SelectField, SelectMultipleField, DateTimeField, BooleanField
-from wtforms.validators import DataRequired, AnyOf, URL
+from wtforms import StringField, SelectField, SelectMultipleField, DateTimeField, BooleanField, IntegerField, HiddenField, TextAreaField
+from wtforms.validators import DataRequired, AnyOf, URL, NumberRange
 
 
 class ShowForm(Form):
@@ -16,6 +17,18 @@ class ShowForm(Form):
         validators=[DataRequired()],
         default=datetime.today()
     )
+    duration = IntegerField(
+        'duration',
+        validators=[DataRequired(), NumberRange(min=1, max=24 * 60)],
+        default=120
+    )
+
+
+class ShowBatchForm(Form):
+    # one show per line: artist_id, venue_id, start_time[, duration]
+    shows = TextAreaField(
+        'shows', validators=[DataRequired()]
+    )
 
 
 class VenueForm(Form):
@@ -127,6 +140,10 @@ class VenueForm(Form):
     seeking_description = StringField(
         'seeking_description'
     )
+    idempotency_key = HiddenField(
+        # fresh per rendered form, so a double submit maps onto one record
+        'idempotency_key', default=lambda: uuid.uuid4().hex
+    )
 
 
 class ArtistForm(Form):
@@ -237,5 +254,9 @@ class ArtistForm(Form):
     seeking_description = StringField(
         'seeking_description'
     )
+    idempotency_key = HiddenField(
+        # fresh per rendered form, so a double submit maps onto one record
+        'idempotency_key', default=lambda: uuid.uuid4().hex
+    )
 
 # TODO IMPLEMENT NEW ARTIST FORM AND NEW SHOW FORM
@@ -0,0 +1,248 @@
+"""Concurrent load generator for Fyyur.
+
+Starts the app locally (or targets --url), replays a mix of real routes at
+fixed client concurrency levels and records throughput, error rate and latency
+percentiles. Sweeping --workers restarts the server with that many worker
+processes (gunicorn when installed, otherwise the threaded development server)
+so the report shows how throughput scales. A server started here runs with
+RATE_LIMITS off, so the curves measure the app rather than the rate limiter;
+429s and other 4xx responses are reported in their own columns either way.
+
+    python loadtest.py --mix browse,search,writes --concurrency 1,4,16 --workers 1,2,4
+"""
+import argparse
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+SEARCH_TERMS = ['a', 'the', 'music', 'hop', 'band', 'jazz', 'park', 'live', 'x']
+GENRES = ['Jazz', 'Rock n Roll', 'Blues', 'Folk', 'Pop']
+
+
+def venue_form(name):
+    return {
+        'name': name, 'city': 'San Francisco', 'state': 'CA', 'address': '1 Market St',
+        'phone': '415-000-0000', 'image_link': '', 'facebook_link': 'https://facebook.com/fyyur',
+        'genres': random.sample(GENRES, 2), 'seeking_talent': 'True', 'seeking_description': '',
+        'website': 'https://example.com', 'idempotency_key': uuid.uuid4().hex
+    }
+
+
+def artist_form(name):
+    return {
+        'name': name, 'city': 'San Francisco', 'state': 'CA', 'phone': '415-000-0000',
+        'image_link': '', 'facebook_link': 'https://facebook.com/fyyur', 'genres': random.sample(GENRES, 2),
+        'seeking_venue': 'True', 'seeking_description': '', 'website': 'https://example.com',
+        'idempotency_key': uuid.uuid4().hex
+    }
+
+
+# each mix is a weighted list of (label, method, path, form) factories
+def browse(ids):
+    return random.choice([
+        ('home', 'GET', '/', None),
+        ('venues', 'GET', '/venues', None),
+        ('artists', 'GET', '/artists', None),
+        ('shows', 'GET', '/shows', None),
+        ('venue', 'GET', '/venues/%d' % random.choice(ids['venues']), None),
+        ('artist', 'GET', '/artists/%d' % random.choice(ids['artists']), None),
+    ])
+
+
+def search(ids):
+    kind = random.choice(['venues', 'artists'])
+    return ('search_' + kind, 'POST', '/%s/search' % kind, {'search_term': random.choice(SEARCH_TERMS)})
+
+
+def writes(ids):
+    suffix = uuid.uuid4().hex[:8]
+    choice = random.randrange(4)
+    if choice == 0:
+        return ('create_venue', 'POST', '/venues/create', venue_form('Load Venue ' + suffix))
+    if choice == 1:
+        return ('create_artist', 'POST', '/artists/create', artist_form('Load Artist ' + suffix))
+    if choice == 2:
+        venue_id = random.choice(ids['venues'])
+        return ('edit_venue', 'POST', '/venues/%d/edit' % venue_id, venue_form('Load Venue ' + suffix))
+    start_time = datetime.now() + timedelta(days=random.randrange(365, 3650), minutes=random.randrange(0, 24 * 60))
+    return ('create_show', 'POST', '/shows/create', {
+        'artist_id': random.choice(ids['artists']), 'venue_id': random.choice(ids['venues']),
+        'start_time': start_time.strftime('%Y-%m-%d %H:%M:%S'), 'duration': 60
+    })
+
+
+MIXES = {'browse': browse, 'search': search, 'writes': writes}
+
+
+def app_without_rate_limits():
+    # the app as served by start_server()
+    from app import app
+    app.config['RATE_LIMITS'] = {}
+    return app
+
+
+def send(base_url, method, path, form):
+    data = urlencode(form, doseq=True).encode() if form is not None else None
+    request = Request(base_url + path, data=data, method=method)
+    started = time.perf_counter()
+    try:
+        with urlopen(request, timeout=30) as response:
+            response.read()
+            status = response.status
+    except HTTPError as error:
+        status = error.code
+    except (URLError, OSError):
+        status = None
+    return status, time.perf_counter() - started
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def discover_ids(base_url):
+    ids = {}
+    for kind in ('venues', 'artists'):
+        with urlopen(base_url + '/' + kind, timeout=30) as response:
+            page = response.read().decode()
+        ids[kind] = sorted(set(int(found) for found in re.findall(r'/%s/(\d+)"' % kind, page))) or [1]
+    return ids
+
+
+def run_level(base_url, mix, ids, concurrency, duration):
+    # concurrency client threads replay the mix back to back for duration seconds
+    latencies = []
+    counts = {'errors': 0, 'rate_limited': 0, 'client_errors': 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client():
+        while time.perf_counter() < deadline:
+            label, method, path, form = mix(ids)
+            status, elapsed = send(base_url, method, path, form)
+            with lock:
+                latencies.append(elapsed)
+                if status is None or status >= 500:
+                    counts['errors'] += 1
+                elif status == 429:
+                    counts['rate_limited'] += 1
+                elif status >= 400:
+                    counts['client_errors'] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(client)
+    elapsed = time.perf_counter() - started
+    return {
+        'requests': len(latencies),
+        'throughput_rps': round(len(latencies) / elapsed, 2),
+        'error_rate': round(counts['errors'] / len(latencies), 4) if latencies else None,
+        'rate_limited_rate': round(counts['rate_limited'] / len(latencies), 4) if latencies else None,
+        'client_error_rate': round(counts['client_errors'] / len(latencies), 4) if latencies else None,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        'p90_ms': round(percentile(latencies, 0.90) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(workers):
+    port = free_port()
+    try:
+        import gunicorn  # noqa: F401
+        command = [sys.executable, '-m', 'gunicorn', '-w', str(workers), '--threads', '4',
+                   '-b', '127.0.0.1:%d' % port, 'loadtest:app_without_rate_limits()']
+    except ImportError:
+        if workers > 1:
+            print('gunicorn is not installed; running a single threaded development server')
+        command = [sys.executable, '-c',
+                   'from loadtest import app_without_rate_limits; '
+                   'app_without_rate_limits().run(host="127.0.0.1", port=%d, threaded=True, debug=False)' % port]
+    server = subprocess.Popen(command, cwd=basedir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = 'http://127.0.0.1:%d' % port
+    for _ in range(100):
+        try:
+            urlopen(base_url + '/', timeout=1).read()
+            return server, base_url
+        except (URLError, OSError):
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('the app did not start on port %d' % port)
+
+
+def write_report(path, results):
+    with open(path + '.json', 'w') as report:
+        json.dump(results, report, indent=2)
+    with open(path + '.md', 'w') as report:
+        report.write('# Fyyur load test, %s\n\n' % datetime.now().strftime('%Y-%m-%d %H:%M'))
+        report.write('| mix | workers | concurrency | requests | req/s | error rate | 429 rate | other 4xx rate '
+                     '| p50 ms | p90 ms | p99 ms |\n')
+        report.write('|---|---|---|---|---|---|---|---|---|---|---|\n')
+        for row in results:
+            report.write('| {mix} | {workers} | {concurrency} | {requests} | {throughput_rps} | {error_rate} '
+                         '| {rate_limited_rate} | {client_error_rate} | {p50_ms} | {p90_ms} | {p99_ms} |\n'.format(**row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mix', default='browse,search', help='comma separated: ' + ', '.join(MIXES))
+    parser.add_argument('--concurrency', default='1,2,4,8,16', help='client concurrency levels to sweep')
+    parser.add_argument('--workers', default='1', help='server worker counts to sweep')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per concurrency level')
+    parser.add_argument('--url', help='target an already running server instead of starting one')
+    parser.add_argument('--report', default=os.path.join(basedir, 'loadtest_report'),
+                        help='report path, written as <path>.json and <path>.md')
+    args = parser.parse_args()
+
+    mixes = [name.strip() for name in args.mix.split(',')]
+    levels = [int(level) for level in args.concurrency.split(',')]
+    worker_counts = [None] if args.url else [int(count) for count in args.workers.split(',')]
+    results = []
+    for workers in worker_counts:
+        server = None
+        base_url = args.url.rstrip('/') if args.url else None
+        if base_url is None:
+            server, base_url = start_server(workers)
+        try:
+            ids = discover_ids(base_url)
+            for name in mixes:
+                for concurrency in levels:
+                    row = dict(run_level(base_url, MIXES[name], ids, concurrency, args.duration),
+                               mix=name, workers=workers or '-', concurrency=concurrency)
+                    print('{mix:>7} workers={workers} concurrency={concurrency:>3} '
+                          '{throughput_rps:>8} req/s errors={error_rate} 429={rate_limited_rate} '
+                          '4xx={client_error_rate} p99={p99_ms}ms'.format(**row))
+                    results.append(row)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+    write_report(args.report, results)
+    print('Report written to %s.md and %s.json' % (args.report, args.report))
+
+
+if __name__ == '__main__':
+    main()
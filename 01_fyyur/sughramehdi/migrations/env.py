@@ -1,6 +1,8 @@
 from __future__ import with_statement
 
 import logging
+import os
+import sys
 from logging.config import fileConfig
 
 from sqlalchemy import engine_from_config
@@ -27,6 +29,9 @@ config.set_main_option(
     str(current_app.extensions['migrate'].db.engine.url).replace('%', '%%'))
 target_metadata = current_app.extensions['migrate'].db.metadata
 
+# lets revisions import the online schema change helpers in online_ops.py
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -83,6 +88,9 @@ def run_migrations_online():
             connection=connection,
             target_metadata=target_metadata,
             process_revision_directives=process_revision_directives,
+            # commit after each revision instead of holding one transaction
+            # (and its locks) for the whole upgrade
+            transaction_per_migration=True,
             **current_app.extensions['migrate'].configure_args
         )
 
@@ -0,0 +1,152 @@
+"""Helpers for schema changes that must not block a live database.
+
+Alembic runs each revision in a transaction, so a plain op.create_index or a
+table-wide UPDATE holds its locks until the whole revision commits. Revisions
+that touch large tables should use these instead:
+
+    from online_ops import add_column, backfill, create_index_concurrently, set_not_null
+
+    add_column('venues', sa.Column('slug', sa.String(120), nullable=True))
+    backfill('venues_slug', 'venues', "slug = lower(replace(name, ' ', '-'))", where='slug IS NULL')
+    create_index_concurrently('ix_venues_slug', 'venues', ['slug'], unique=True)
+    set_not_null('venues', 'slug')
+
+Backfills record their progress in the online_backfills table; an interrupted
+upgrade picks up after the last finished batch when it is run again. Their
+assignments must therefore be safe to apply twice, and rows inserted after
+the backfill starts are left to the application, which should already be
+writing the new column by then.
+"""
+import logging
+import time
+
+from alembic import op
+from flask import current_app
+from sqlalchemy import text
+
+logger = logging.getLogger('alembic.online')
+
+PROGRESS_TABLE = 'online_backfills'
+
+
+def is_postgres():
+    return op.get_bind().dialect.name == 'postgresql'
+
+
+def set_lock_timeout():
+    # fail fast rather than queue every other query behind an ACCESS EXCLUSIVE lock
+    if is_postgres():
+        op.execute("SET LOCAL lock_timeout = '%s'" % current_app.config['MIGRATION_LOCK_TIMEOUT'])
+
+
+def add_column(table, column):
+    # nullable columns and constant defaults are catalog-only changes on
+    # Postgres 11+; NOT NULL without a default would rewrite (or fail on) the table
+    if not column.nullable and column.server_default is None:
+        raise ValueError(
+            'add %s.%s as nullable, backfill it, then call set_not_null' % (table, column.name))
+    set_lock_timeout()
+    op.add_column(table, column)
+
+
+def set_not_null(table, column):
+    if not is_postgres():
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column(column, nullable=False)
+        return
+    # a validated CHECK lets SET NOT NULL skip its full-table scan (Postgres 12+),
+    # and VALIDATE only takes a SHARE UPDATE EXCLUSIVE lock
+    check = '%s_%s_not_null' % (table, column)
+    set_lock_timeout()
+    op.execute('ALTER TABLE %s ADD CONSTRAINT %s CHECK (%s IS NOT NULL) NOT VALID' % (table, check, column))
+    op.execute('ALTER TABLE %s VALIDATE CONSTRAINT %s' % (table, check))
+    op.execute('ALTER TABLE %s ALTER COLUMN %s SET NOT NULL' % (table, column))
+    op.execute('ALTER TABLE %s DROP CONSTRAINT %s' % (table, check))
+
+
+def create_index_concurrently(name, table, columns, **kw):
+    if not is_postgres():
+        op.create_index(name, table, columns, **kw)
+        return
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        # a failed concurrent build leaves an INVALID index behind; rebuild it
+        valid = bind.execute(text(
+            'SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+            'WHERE c.relname = :name'), name=name).scalar()
+        if valid:
+            logger.info('index %s already exists', name)
+            return
+        if valid is not None:
+            op.execute('DROP INDEX CONCURRENTLY %s' % name)
+        op.create_index(name, table, columns, postgresql_concurrently=True, **kw)
+
+
+def drop_index_concurrently(name, table):
+    if not is_postgres():
+        op.drop_index(name, table_name=table)
+        return
+    with op.get_context().autocommit_block():
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % name)
+
+
+def backfill(name, table, assignments, where='1 = 1', key='id', batch_size=None, pause=None):
+    # UPDATE table SET assignments WHERE where, batch_size keys at a time, each
+    # batch committed on its own so locks are short and replicas keep up
+    if op.get_context().as_sql:
+        op.execute('UPDATE %s SET %s WHERE %s' % (table, assignments, where))
+        return
+    batch_size = batch_size or current_app.config['BACKFILL_BATCH_SIZE']
+    pause = current_app.config['BACKFILL_BATCH_PAUSE'] if pause is None else pause
+
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        bind.execute(
+            'CREATE TABLE IF NOT EXISTS %s (name VARCHAR(120) PRIMARY KEY, last_key BIGINT, '
+            'rows_done BIGINT NOT NULL DEFAULT 0, finished_at TIMESTAMP)' % PROGRESS_TABLE)
+        progress = bind.execute(text(
+            'SELECT last_key, rows_done, finished_at FROM %s WHERE name = :name' % PROGRESS_TABLE),
+            name=name).fetchone()
+        if progress is None:
+            bind.execute(text('INSERT INTO %s (name) VALUES (:name)' % PROGRESS_TABLE), name=name)
+            last_key, rows_done = None, 0
+        elif progress.finished_at is not None:
+            logger.info('backfill %s already finished at %s', name, progress.finished_at)
+            return
+        else:
+            last_key, rows_done = progress.last_key, progress.rows_done
+            logger.info('backfill %s resuming after %s=%s', name, key, last_key)
+
+        first_key, max_key = bind.execute('SELECT min(%s), max(%s) FROM %s' % (key, key, table)).fetchone()
+        if last_key is None and first_key is not None:
+            last_key = first_key - 1
+        started = time.time()
+        resumed_rows = rows_done
+
+        while max_key is not None and last_key < max_key:
+            # upper key of the next batch, found by an index scan on key
+            upper = bind.execute(text(
+                'SELECT %s FROM %s WHERE %s > :last ORDER BY %s LIMIT 1 OFFSET :skip'
+                % (key, table, key, key)), last=last_key, skip=batch_size - 1).scalar()
+            if upper is None:
+                upper = max_key
+            updated = bind.execute(text(
+                'UPDATE %s SET %s WHERE %s > :last AND %s <= :upper AND (%s)'
+                % (table, assignments, key, key, where)), last=last_key, upper=upper).rowcount
+            rows_done += max(updated, 0)
+            last_key = upper
+            bind.execute(text(
+                'UPDATE %s SET last_key = :last, rows_done = :done WHERE name = :name' % PROGRESS_TABLE),
+                last=last_key, done=rows_done, name=name)
+
+            elapsed = time.time() - started
+            logger.info(
+                'backfill %s: %d rows, %s=%s of %s (%.1f%%), %.0f rows/s', name, rows_done, key, last_key,
+                max_key, 100.0 * (last_key - first_key + 1) / (max_key - first_key + 1),
+                (rows_done - resumed_rows) / elapsed if elapsed else 0)
+            time.sleep(pause)
+
+        bind.execute(text(
+            'UPDATE %s SET finished_at = CURRENT_TIMESTAMP WHERE name = :name' % PROGRESS_TABLE), name=name)
+        logger.info('backfill %s finished: %d rows', name, rows_done)
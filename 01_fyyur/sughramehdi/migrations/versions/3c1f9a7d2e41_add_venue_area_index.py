@@ -0,0 +1,24 @@
+"""add venue area index
+
+Revision ID: 3c1f9a7d2e41
+Revises: 43da3ebe42db
+Create Date: 2026-10-19 09:12:40.518302
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c1f9a7d2e41'
+down_revision = '43da3ebe42db'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_venues_state_city_name', 'venues', ['state', 'city', 'name'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_venues_state_city_name', table_name='venues')
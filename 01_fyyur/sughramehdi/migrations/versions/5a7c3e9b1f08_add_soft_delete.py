@@ -0,0 +1,47 @@
+"""add soft delete
+
+Revision ID: 5a7c3e9b1f08
+Revises: 8e2b5d04c7a9
+Create Date: 2026-10-19 11:26:52.731466
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a7c3e9b1f08'
+down_revision = '8e2b5d04c7a9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('venues', sa.Column('deleted_at', sa.DateTime(), nullable=True))
+    op.add_column('artists', sa.Column('deleted_at', sa.DateTime(), nullable=True))
+    op.drop_index('ix_venues_state_city_name', table_name='venues')
+    op.create_index('ix_venues_live_state_city_name', 'venues', ['state', 'city', 'name'], unique=False,
+                    postgresql_where=sa.text('deleted_at IS NULL'), sqlite_where=sa.text('deleted_at IS NULL'))
+    op.create_index('ix_artists_live_name', 'artists', ['name'], unique=False,
+                    postgresql_where=sa.text('deleted_at IS NULL'), sqlite_where=sa.text('deleted_at IS NULL'))
+    # SQLite cannot alter constraints and its foreign keys from 43da3ebe42db are
+    # unnamed; the purger deletes a venue's or artist's shows before the row, so
+    # nothing there relies on the cascade
+    if op.get_bind().dialect.name != 'sqlite':
+        op.drop_constraint('showdetails_venue_id_fkey', 'showdetails', type_='foreignkey')
+        op.drop_constraint('showdetails_artist_id_fkey', 'showdetails', type_='foreignkey')
+        op.create_foreign_key('showdetails_venue_id_fkey', 'showdetails', 'venues', ['venue_id'], ['id'], ondelete='CASCADE')
+        op.create_foreign_key('showdetails_artist_id_fkey', 'showdetails', 'artists', ['artist_id'], ['id'], ondelete='CASCADE')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        op.drop_constraint('showdetails_artist_id_fkey', 'showdetails', type_='foreignkey')
+        op.drop_constraint('showdetails_venue_id_fkey', 'showdetails', type_='foreignkey')
+        op.create_foreign_key('showdetails_artist_id_fkey', 'showdetails', 'artists', ['artist_id'], ['id'])
+        op.create_foreign_key('showdetails_venue_id_fkey', 'showdetails', 'venues', ['venue_id'], ['id'])
+    op.drop_index('ix_artists_live_name', table_name='artists')
+    op.drop_index('ix_venues_live_state_city_name', table_name='venues')
+    op.create_index('ix_venues_state_city_name', 'venues', ['state', 'city', 'name'], unique=False)
+    op.drop_column('artists', 'deleted_at')
+    op.drop_column('venues', 'deleted_at')
@@ -0,0 +1,62 @@
+"""add show duration and booking constraints
+
+Revision ID: 8e2b5d04c7a9
+Revises: 3c1f9a7d2e41
+Create Date: 2026-10-19 10:03:17.204815
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e2b5d04c7a9'
+down_revision = '3c1f9a7d2e41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.alter_column('showdetails', 'start_time',
+                   existing_type=sa.String(),
+                   type_=sa.DateTime(),
+                   existing_nullable=False,
+                   postgresql_using='start_time::timestamp')
+    else:
+        # SQLite cannot alter a column type in place; batch mode copies the table
+        with op.batch_alter_table('showdetails') as batch_op:
+            batch_op.alter_column('start_time',
+                       existing_type=sa.String(),
+                       type_=sa.DateTime(),
+                       existing_nullable=False)
+    op.add_column('showdetails', sa.Column('duration', sa.Integer(), server_default='120', nullable=False))
+    op.create_index('ix_showdetails_venue_id_start_time', 'showdetails', ['venue_id', 'start_time'], unique=False)
+    op.create_index('ix_showdetails_artist_id_start_time', 'showdetails', ['artist_id', 'start_time'], unique=False)
+    if op.get_bind().dialect.name == 'postgresql':
+        # reject overlapping bookings for the same venue or artist inside the database
+        op.execute('CREATE EXTENSION IF NOT EXISTS btree_gist')
+        op.execute(
+            "ALTER TABLE showdetails ADD CONSTRAINT showdetails_venue_no_overlap "
+            "EXCLUDE USING gist (venue_id WITH =, "
+            "tsrange(start_time, start_time + duration * interval '1 minute') WITH &&)"
+        )
+        op.execute(
+            "ALTER TABLE showdetails ADD CONSTRAINT showdetails_artist_no_overlap "
+            "EXCLUDE USING gist (artist_id WITH =, "
+            "tsrange(start_time, start_time + duration * interval '1 minute') WITH &&)"
+        )
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_constraint('showdetails_artist_no_overlap', 'showdetails')
+        op.drop_constraint('showdetails_venue_no_overlap', 'showdetails')
+    op.drop_index('ix_showdetails_artist_id_start_time', table_name='showdetails')
+    op.drop_index('ix_showdetails_venue_id_start_time', table_name='showdetails')
+    with op.batch_alter_table('showdetails') as batch_op:
+        batch_op.drop_column('duration')
+        batch_op.alter_column('start_time',
+                   existing_type=sa.DateTime(),
+                   type_=sa.String(),
+                   existing_nullable=False)
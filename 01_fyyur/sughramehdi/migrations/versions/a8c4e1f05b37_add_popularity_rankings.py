@@ -0,0 +1,46 @@
+"""add popularity rankings
+
+Revision ID: a8c4e1f05b37
+Revises: f3b7d2a61c94
+Create Date: 2026-10-19 17:20:44.918275
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a8c4e1f05b37'
+down_revision = 'f3b7d2a61c94'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the tables start empty; the first popularity refresh finds no
+    # popularity_state row and counts every show in the widest window
+    for kind in ('venue', 'artist'):
+        op.create_table('%s_popularity' % kind,
+        sa.Column('%s_id' % kind, sa.Integer(), nullable=False),
+        sa.Column('shows_7d', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('shows_30d', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('shows_90d', sa.Integer(), server_default='0', nullable=False),
+        sa.ForeignKeyConstraint(['%s_id' % kind], ['%ss.id' % kind], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('%s_id' % kind)
+        )
+        for days in (7, 30, 90):
+            op.create_index('ix_%s_popularity_shows_%dd' % (kind, days), '%s_popularity' % kind,
+                            ['shows_%dd' % days, '%s_id' % kind], unique=False)
+    op.create_table('popularity_state',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('as_of', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('popularity_state')
+    for kind in ('artist', 'venue'):
+        for days in (90, 30, 7):
+            op.drop_index('ix_%s_popularity_shows_%dd' % (kind, days), table_name='%s_popularity' % kind)
+        op.drop_table('%s_popularity' % kind)
@@ -16,52 +16,14 @@ branch_labels = None
 depends_on = None
 
 
+# This second root used to create capitalised Artist/Venue/ShowDetails tables the
+# app never reads. e5a93c1d7f62 merges it into the main history, so it now runs on
+# every fresh database and creates nothing. Downgrading leaves any such tables an
+# old run created: SQLite matches table names without regard to case, so dropping
+# "ShowDetails" there would drop the real showdetails table.
 def upgrade():
-    # ### commands auto generated by Alembic - please adjust! ###
-    op.create_table('Artist',
-    sa.Column('id', sa.Integer(), nullable=False),
-    sa.Column('name', sa.String(), nullable=False),
-    sa.Column('city', sa.String(length=120), nullable=True),
-    sa.Column('state', sa.String(length=120), nullable=True),
-    sa.Column('phone', sa.String(length=120), nullable=True),
-    sa.Column('genres', sa.String(length=120), nullable=True),
-    sa.Column('image_link', sa.String(length=500), nullable=True),
-    sa.Column('facebook_link', sa.String(length=120), nullable=True),
-    sa.Column('website', sa.String(length=120), nullable=True),
-    sa.Column('seeking_venue', sa.String(length=120), nullable=True),
-    sa.Column('seeking_description', sa.String(length=120), nullable=True),
-    sa.PrimaryKeyConstraint('id')
-    )
-    op.create_table('Venue',
-    sa.Column('id', sa.Integer(), nullable=False),
-    sa.Column('name', sa.String(), nullable=False),
-    sa.Column('city', sa.String(length=120), nullable=True),
-    sa.Column('state', sa.String(length=120), nullable=True),
-    sa.Column('address', sa.String(length=120), nullable=True),
-    sa.Column('phone', sa.String(length=120), nullable=True),
-    sa.Column('image_link', sa.String(length=500), nullable=True),
-    sa.Column('facebook_link', sa.String(length=120), nullable=True),
-    sa.Column('genres', sa.String(length=120), nullable=True),
-    sa.Column('website', sa.String(length=120), nullable=True),
-    sa.Column('seeking_talent', sa.String(length=120), nullable=True),
-    sa.Column('seeking_description', sa.String(length=120), nullable=True),
-    sa.PrimaryKeyConstraint('id')
-    )
-    op.create_table('ShowDetails',
-    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
-    sa.Column('venue_id', sa.Integer(), nullable=False),
-    sa.Column('artist_id', sa.Integer(), nullable=False),
-    sa.Column('start_time', sa.String(), nullable=False),
-    sa.ForeignKeyConstraint(['artist_id'], ['Artist.id'], ),
-    sa.ForeignKeyConstraint(['venue_id'], ['Venue.id'], ),
-    sa.PrimaryKeyConstraint('id', 'venue_id', 'artist_id')
-    )
-    # ### end Alembic commands ###
+    pass
 
 
 def downgrade():
-    # ### commands auto generated by Alembic - please adjust! ###
-    op.drop_table('ShowDetails')
-    op.drop_table('Venue')
-    op.drop_table('Artist')
-    # ### end Alembic commands ###
+    pass
@@ -0,0 +1,35 @@
+"""add idempotency keys
+
+Revision ID: b4d81f6a9c23
+Revises: 5a7c3e9b1f08
+Create Date: 2026-10-19 13:41:08.915530
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b4d81f6a9c23'
+down_revision = '5a7c3e9b1f08'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # batch mode so SQLite, which cannot add a constraint in place, copies the table
+    with op.batch_alter_table('venues') as batch_op:
+        batch_op.add_column(sa.Column('idempotency_key', sa.String(length=64), nullable=True))
+        batch_op.create_unique_constraint('venues_idempotency_key_key', ['idempotency_key'])
+    with op.batch_alter_table('artists') as batch_op:
+        batch_op.add_column(sa.Column('idempotency_key', sa.String(length=64), nullable=True))
+        batch_op.create_unique_constraint('artists_idempotency_key_key', ['idempotency_key'])
+
+
+def downgrade():
+    with op.batch_alter_table('artists') as batch_op:
+        batch_op.drop_constraint('artists_idempotency_key_key', type_='unique')
+        batch_op.drop_column('idempotency_key')
+    with op.batch_alter_table('venues') as batch_op:
+        batch_op.drop_constraint('venues_idempotency_key_key', type_='unique')
+        batch_op.drop_column('idempotency_key')
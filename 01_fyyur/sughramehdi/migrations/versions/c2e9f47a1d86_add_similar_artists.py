@@ -0,0 +1,32 @@
+"""add similar artists
+
+Revision ID: c2e9f47a1d86
+Revises: a8c4e1f05b37
+Create Date: 2026-10-19 18:02:17.530614
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2e9f47a1d86'
+down_revision = 'a8c4e1f05b37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('similar_artists',
+    sa.Column('artist_id', sa.Integer(), nullable=False),
+    sa.Column('rank', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('similar_id', sa.Integer(), nullable=False),
+    sa.Column('score', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['artist_id'], ['artists.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['similar_id'], ['artists.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('artist_id', 'rank')
+    )
+
+
+def downgrade():
+    op.drop_table('similar_artists')
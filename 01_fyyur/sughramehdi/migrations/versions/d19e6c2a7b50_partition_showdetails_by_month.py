@@ -0,0 +1,100 @@
+"""partition showdetails by month
+
+Revision ID: d19e6c2a7b50
+Revises: b4d81f6a9c23
+Create Date: 2026-10-19 14:52:33.480127
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd19e6c2a7b50'
+down_revision = 'b4d81f6a9c23'
+branch_labels = None
+depends_on = None
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def create_partition(month):
+    name = 'showdetails_y%04dm%02d' % (month.year, month.month)
+    op.execute(
+        "CREATE TABLE %s PARTITION OF showdetails FOR VALUES FROM ('%s') TO ('%s')"
+        % (name, month.isoformat(), add_months(month, 1).isoformat()))
+    for column in ('venue_id', 'artist_id'):
+        op.execute(
+            "ALTER TABLE %s ADD CONSTRAINT %s_%s_no_overlap EXCLUDE USING gist "
+            "(%s WITH =, tsrange(start_time, start_time + duration * interval '1 minute') WITH &&)"
+            % (name, name, column.split('_')[0], column))
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('ALTER TABLE showdetails RENAME TO showdetails_unpartitioned')
+    op.execute('ALTER INDEX showdetails_pkey RENAME TO showdetails_unpartitioned_pkey')
+    op.execute(
+        "CREATE TABLE showdetails ("
+        "id integer NOT NULL DEFAULT nextval('showdetails_id_seq'), "
+        "venue_id integer REFERENCES venues (id) ON DELETE CASCADE, "
+        "artist_id integer REFERENCES artists (id) ON DELETE CASCADE, "
+        "start_time timestamp without time zone NOT NULL, "
+        "duration integer NOT NULL DEFAULT 120, "
+        "PRIMARY KEY (id, start_time)"
+        ") PARTITION BY RANGE (start_time)")
+    # catches rows outside every monthly partition until maintenance creates theirs
+    op.execute('CREATE TABLE showdetails_default PARTITION OF showdetails DEFAULT')
+
+    this_month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    first, last = op.get_bind().execute(
+        'SELECT min(start_time), max(start_time) FROM showdetails_unpartitioned').fetchone()
+    month = min(first, this_month).replace(day=1, hour=0, minute=0, second=0, microsecond=0) if first else this_month
+    last = max(last or this_month, add_months(this_month, 12))
+    while month <= last:
+        create_partition(month)
+        month = add_months(month, 1)
+
+    op.execute(
+        'INSERT INTO showdetails (id, venue_id, artist_id, start_time, duration) '
+        'SELECT id, venue_id, artist_id, start_time, duration FROM showdetails_unpartitioned')
+    op.execute('ALTER SEQUENCE showdetails_id_seq OWNED BY showdetails.id')
+    op.execute('DROP TABLE showdetails_unpartitioned')
+    op.create_index('ix_showdetails_venue_id_start_time', 'showdetails', ['venue_id', 'start_time'], unique=False)
+    op.create_index('ix_showdetails_artist_id_start_time', 'showdetails', ['artist_id', 'start_time'], unique=False)
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('ALTER TABLE showdetails RENAME TO showdetails_partitioned')
+    op.execute('ALTER INDEX ix_showdetails_venue_id_start_time RENAME TO ix_showdetails_partitioned_venue_id_start_time')
+    op.execute('ALTER INDEX ix_showdetails_artist_id_start_time RENAME TO ix_showdetails_partitioned_artist_id_start_time')
+    op.execute(
+        "CREATE TABLE showdetails ("
+        "id integer NOT NULL DEFAULT nextval('showdetails_id_seq') PRIMARY KEY, "
+        "venue_id integer CONSTRAINT showdetails_venue_id_fkey REFERENCES venues (id) ON DELETE CASCADE, "
+        "artist_id integer CONSTRAINT showdetails_artist_id_fkey REFERENCES artists (id) ON DELETE CASCADE, "
+        "start_time timestamp without time zone NOT NULL, "
+        "duration integer NOT NULL DEFAULT 120)")
+    op.execute(
+        'INSERT INTO showdetails (id, venue_id, artist_id, start_time, duration) '
+        'SELECT id, venue_id, artist_id, start_time, duration FROM showdetails_partitioned')
+    op.execute('ALTER SEQUENCE showdetails_id_seq OWNED BY showdetails.id')
+    op.execute('DROP TABLE showdetails_partitioned')
+    op.create_index('ix_showdetails_venue_id_start_time', 'showdetails', ['venue_id', 'start_time'], unique=False)
+    op.create_index('ix_showdetails_artist_id_start_time', 'showdetails', ['artist_id', 'start_time'], unique=False)
+    op.execute(
+        "ALTER TABLE showdetails ADD CONSTRAINT showdetails_venue_no_overlap "
+        "EXCLUDE USING gist (venue_id WITH =, "
+        "tsrange(start_time, start_time + duration * interval '1 minute') WITH &&)")
+    op.execute(
+        "ALTER TABLE showdetails ADD CONSTRAINT showdetails_artist_no_overlap "
+        "EXCLUDE USING gist (artist_id WITH =, "
+        "tsrange(start_time, start_time + duration * interval '1 minute') WITH &&)")
@@ -0,0 +1,27 @@
+"""merge the legacy root revision into the main history
+
+Revision ID: e5a93c1d7f62
+Revises: ad7d0a2ed128, d19e6c2a7b50
+Create Date: 2026-10-19 16:05:12.604381
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a93c1d7f62'
+down_revision = ('ad7d0a2ed128', 'd19e6c2a7b50')
+branch_labels = None
+depends_on = None
+
+
+# ad7d0a2ed128 was never chained to 43da3ebe42db, which left two heads and made
+# a bare `flask db upgrade` fail. Merging them gives later revisions a single
+# head to build on; ad7d0a2ed128 itself no longer creates any tables.
+def upgrade():
+    pass
+
+
+def downgrade():
+    pass
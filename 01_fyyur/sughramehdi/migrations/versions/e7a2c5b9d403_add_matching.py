@@ -0,0 +1,66 @@
+"""add matching
+
+Revision ID: e7a2c5b9d403
+Revises: c2e9f47a1d86
+Create Date: 2026-10-19 19:11:52.406381
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from online_ops import add_column, backfill, create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7a2c5b9d403'
+down_revision = 'c2e9f47a1d86'
+branch_labels = None
+depends_on = None
+
+# frozen copy of app.MATCH_GENRES at this revision; bit i is GENRES[i]
+GENRES = [
+    'Alternative', 'Blues', 'Classical', 'Country', 'Electronic', 'Folk', 'Funk', 'Hip-Hop',
+    'Heavy Metal', 'Instrumental', 'Jazz', 'Musical Theatre', 'Pop', 'Punk', 'R&B', 'Reggae',
+    'Rock n Roll', 'Soul', 'Other'
+]
+
+# same rule as app.genre_mask(): genres are stored space separated
+GENRE_MASK = ' + '.join(
+    "(CASE WHEN ' ' || lower(coalesce(genres, '')) || ' ' LIKE '%% %s %%' THEN %d ELSE 0 END)"
+    % (genre.lower(), 1 << bit) for bit, genre in enumerate(GENRES))
+
+SEEKING = {'venues': 'seeking_talent', 'artists': 'seeking_venue'}
+
+
+def upgrade():
+    for table, seeking in SEEKING.items():
+        add_column(table, sa.Column('genre_mask', sa.BigInteger(), nullable=True))
+        backfill('%s_genre_mask' % table, table, 'genre_mask = ' + GENRE_MASK, where='genre_mask IS NULL')
+        where = sa.text("%s = 'True' AND deleted_at IS NULL" % seeking)
+        create_index_concurrently('ix_%s_seeking_state_city' % table, table, ['state', 'city'],
+                                  postgresql_where=where, sqlite_where=where)
+
+    # the lists start empty; fill them with `flask rebuild-matches` after deploying
+    for kind, other in (('venue', 'artist'), ('artist', 'venue')):
+        op.create_table('%s_matches' % kind,
+        sa.Column('%s_id' % kind, sa.Integer(), nullable=False),
+        sa.Column('%s_id' % other, sa.Integer(), nullable=False),
+        sa.Column('score', sa.Float(), nullable=False),
+        sa.ForeignKeyConstraint(['%s_id' % kind], ['%ss.id' % kind], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['%s_id' % other], ['%ss.id' % other], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('%s_id' % kind, '%s_id' % other)
+        )
+        op.create_index('ix_%s_matches_%s_id_score' % (kind, kind), '%s_matches' % kind,
+                        ['%s_id' % kind, 'score'], unique=False)
+        op.create_index('ix_%s_matches_%s_id' % (kind, other), '%s_matches' % kind,
+                        ['%s_id' % other], unique=False)
+
+
+def downgrade():
+    for kind, other in (('artist', 'venue'), ('venue', 'artist')):
+        op.drop_index('ix_%s_matches_%s_id' % (kind, other), table_name='%s_matches' % kind)
+        op.drop_index('ix_%s_matches_%s_id_score' % (kind, kind), table_name='%s_matches' % kind)
+        op.drop_table('%s_matches' % kind)
+    for table in ('artists', 'venues'):
+        drop_index_concurrently('ix_%s_seeking_state_city' % table, table)
+        op.drop_column(table, 'genre_mask')
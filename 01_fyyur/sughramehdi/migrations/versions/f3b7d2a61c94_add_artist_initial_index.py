@@ -0,0 +1,31 @@
+"""add artist initial index
+
+Revision ID: f3b7d2a61c94
+Revises: e5a93c1d7f62
+Create Date: 2026-10-19 16:41:08.215930
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from online_ops import create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b7d2a61c94'
+down_revision = 'e5a93c1d7f62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # serves the letter buckets and keyset pages of /artists; built without
+    # blocking writes to artists
+    create_index_concurrently('ix_artists_live_initial_name', 'artists',
+                              [sa.text('upper(substr(name, 1, 1))'), 'name', 'id'],
+                              postgresql_where=sa.text('deleted_at IS NULL'),
+                              sqlite_where=sa.text('deleted_at IS NULL'))
+
+
+def downgrade():
+    drop_index_concurrently('ix_artists_live_initial_name', 'artists')